@@ -0,0 +1 @@
+# 让 pytest 从仓库根目录导入 image_processor 等模块
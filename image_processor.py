@@ -1,123 +1,1322 @@
+import time
+
+# 模块开始导入的时间，--timing 以此计算启动耗时
+_IMPORT_STARTED = time.perf_counter()
+
 import os
-import re
-from PIL import Image
-from PIL.ExifTags import TAGS
+import sys
+import json
+import fnmatch
+import struct
+import io
+import math
+import logging
+import posixpath
+import zlib
+import importlib.util
+from collections import OrderedDict, namedtuple
 import argparse
 from datetime import datetime
 
+try:
+    import resource
+except ImportError:
+    # Windows 不支持限制进程内存
+    resource = None
+
+
+def _lazy_import(name):
+    """
+    延迟导入模块：返回的模块在第一次访问其属性时才真正执行导入
+
+    导入 Pillow 需要几十毫秒，只显示帮助、参数有误或没有需要解码的图片时可以省去。
+    其余只在部分操作中用到的标准库模块（压缩包、进程池等）在使用它们的函数中导入。
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    # 与普通导入一样绑定为父包的属性，否则 import PIL.Image 之后 PIL.Image 不可用
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(importlib.import_module(parent), child, module)
+    return module
+
+
+Image = _lazy_import('PIL.Image')
+
+
+# 缩放模式与 reducing_gap 的对应关系（质量与速度的取舍）
+# reducing_gap 越小，JPEG 在解码时就通过 DCT 缩放（Image.draft）得到越接近目标尺寸的图像，
+# 其余格式则先用 reduce() 做整数倍缩小，然后再用 LANCZOS 精确缩放
+RESIZE_MODES = {
+    'quality': None,   # 完整解码后直接缩放，效果最好但最慢
+    'balanced': 2.0,   # Pillow 默认值，与直接缩放几乎无差别
+    'fast': 1.1,       # 解码尺寸尽量接近目标尺寸，速度最快，内存占用最少
+}
+
+# 按目标大小压缩时的最低JPEG质量和最多编码次数
+TARGET_SIZE_MIN_QUALITY = 10
+TARGET_SIZE_MAX_ATTEMPTS = 8
+
+# 多尺寸输出和压缩支持的格式：格式名 -> (Pillow格式, 扩展名)，AVIF需要Pillow支持（参见 avif_available）
+RENDITION_FORMATS = {
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+    'png': ('PNG', 'png'),
+    'avif': ('AVIF', 'avif'),
+}
+
+# 压缩时可以指定的输出格式，auto 表示逐张图片选择最小的输出
+COMPRESS_FORMATS = ('auto', 'jpeg', 'webp', 'png', 'avif')
+
+# AVIF编码速度 (0-10)，越大越快；8 比 Pillow 默认的 6 快约10倍，文件大小相近
+AVIF_SPEED = 8
+
+# 多尺寸输出的默认文件名模板，可用字段: stem(原文件名), name(尺寸名称), width, height, ext
+DEFAULT_RENDITION_TEMPLATE = '{stem}_{name}.{ext}'
+
+# 增量处理清单的文件名，保存在输出目录（原地处理时即图片目录）中
+MANIFEST_NAME = '.image_processor_manifest.json'
+
+# 断点恢复日志的文件名前缀，保存在输出目录（原地处理时即图片目录）中
+JOURNAL_NAME = '.image_processor_journal'
+
+# 重命名撤销日志的文件名，保存在图片目录中，记录最近一次重命名
+RENAME_UNDO_NAME = '.image_processor_rename_undo.json'
+
+# 感知哈希（dHash）的边长，哈希共 DHASH_SIZE * DHASH_SIZE 位
+DHASH_SIZE = 8
+# 汉明距离不超过该值的图片视为近似重复
+DEDUP_DISTANCE = 5
+# 重复图片的处理方式：skip 不压缩，link 硬链接到原图的输出文件
+DEDUP_MODES = ('skip', 'link')
+
+# 转换为JPEG时透明部分使用的默认背景色
+DEFAULT_BACKGROUND = (255, 255, 255)
+
+# 像素数超过该值的图片使用大图模式：按水平条带解码并立即缩小，不在内存中保留整张图片
+LARGE_IMAGE_PIXELS = 40_000_000
+# 大图模式下每个条带解码后的最大字节数
+STRIP_BYTES = 16 * 1024 * 1024
+# 大图模式可以按条带解码的图片模式（PNG需为8位且非隔行扫描，其他格式需为未压缩数据）
+STRIP_MODES = ('L', 'LA', 'RGB', 'RGBA')
+# 未压缩数据的每像素字节数
+STRIP_RAW_PIXEL_BYTES = {'L': 1, 'LA': 2, 'RGB': 3, 'BGR': 3, 'RGBA': 4, 'BGRA': 4, 'RGBX': 4, 'BGRX': 4}
+# quality 缩放模式不使用 reducing_gap，大图模式下改用该值先整数倍缩小
+LARGE_IMAGE_REDUCING_GAP = 3.0
+# 限制内存时每个工作进程在图片数据之外预留的内存（解释器、编码器等）
+WORKER_MEMORY_OVERHEAD = 256 * 1024 * 1024
+
+# 可以直接作为图片来源或输出的压缩包类型：扩展名 -> tarfile 写入模式（zip 为 None）
+ARCHIVE_FORMATS = {
+    '.zip': None,
+    '.tar': 'w',
+    '.tar.gz': 'w:gz',
+    '.tgz': 'w:gz',
+    '.tar.bz2': 'w:bz2',
+    '.tbz2': 'w:bz2',
+    '.tar.xz': 'w:xz',
+    '.txz': 'w:xz',
+}
+
+# 图片缓存的默认内存预算（字节），同一次运行中的多个操作共享已读取的文件内容
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# 每个缓存条目除文件内容外计入预算的字节数（元数据等）
+CACHE_ENTRY_OVERHEAD = 512
+
+# 扫描得到的图片文件：name 为相对于图片目录的路径，size 和 mtime_ns 来自扫描时的 DirEntry。
+# 来源为压缩包时 name 为成员名，data 为成员的内容
+ImageFile = namedtuple('ImageFile', 'name path size mtime_ns data', defaults=(None,))
+
+
+logger = logging.getLogger('image_processor')
+
+# 指标汇总直方图的区间上限（毫秒）
+METRICS_BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, math.inf)
+
+
+class _TimedStage:
+    __slots__ = ('stages', 'name', 'start')
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.stages[self.name] = self.stages.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _StageTimer:
+    """
+    记录单个文件各处理阶段（open, decode, resize, convert, encode, write 等）的耗时
+
+    stages 为None时不计时，stage() 直接返回共享的空上下文，关闭指标时几乎没有额外开销。
+    """
+
+    __slots__ = ('stages',)
+
+    def __init__(self, stages=None):
+        self.stages = stages
+
+    def stage(self, name):
+        if self.stages is None:
+            return _NULL_STAGE
+        return _TimedStage(self.stages, name)
+
+
+class Metrics:
+    """
+    处理指标收集器
+
+    每处理完一个文件调用一次 add()，记录内容为 dict(operation, file, seconds, stages,
+    bytes_in, bytes_out, error)。可以逐行写入JSON文件、传给用户提供的回调函数，
+    并按阶段汇总为耗时直方图。所有方法都在主进程中调用，回调函数无需可序列化。
+    """
+
+    def __init__(self, jsonl_path=None, hook=None):
+        """
+        Args:
+            jsonl_path: 以JSON lines格式追加写入每个文件记录的路径
+            hook: 每个文件记录的回调函数，参数为记录dict
+        """
+        self.hook = hook
+        self.file_count = 0
+        self.error_count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # 阶段 -> [次数, 总耗时, 最大耗时, 各区间计数]
+        self.stages = {}
+        self._file = open(jsonl_path, 'a', encoding='utf-8') if jsonl_path else None
+
+    def add(self, operation, stats):
+        record = {
+            'operation': operation,
+            'file': stats['filename'],
+            'seconds': stats.get('seconds'),
+            'stages': stats.get('stages', {}),
+            'bytes_in': stats.get('old_size'),
+            'bytes_out': stats.get('new_size'),
+            'error': stats.get('error'),
+        }
+        self.file_count += 1
+        if record['error']:
+            self.error_count += 1
+        self.bytes_in += record['bytes_in'] or 0
+        self.bytes_out += record['bytes_out'] or 0
+        if record['seconds'] is not None:
+            self._observe('total', record['seconds'])
+        for stage, seconds in record['stages'].items():
+            self._observe(stage, seconds)
+
+        if self._file:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        if self.hook:
+            self.hook(record)
+
+    def _observe(self, stage, seconds):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0.0, 0.0, [0] * len(METRICS_BUCKETS_MS)]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        milliseconds = seconds * 1000
+        for i, bound in enumerate(METRICS_BUCKETS_MS):
+            if milliseconds <= bound:
+                entry[3][i] += 1
+                break
+
+    def _bucket_percentile(self, buckets, count, percent):
+        """由直方图估算百分位数，返回所在区间的上限（毫秒）"""
+        threshold = count * percent / 100
+        seen = 0
+        for bound, bucket_count in zip(METRICS_BUCKETS_MS, buckets):
+            seen += bucket_count
+            if seen >= threshold:
+                return bound
+        return math.inf
+
+    def summary(self):
+        """
+        Returns:
+            dict: 阶段 -> dict(count, total_seconds, mean_ms, p50_ms, p95_ms, max_ms, histogram)，
+                p50/p95 为所在直方图区间的上限
+        """
+        result = {}
+        for stage, (count, total, maximum, buckets) in self.stages.items():
+            result[stage] = {
+                'count': count,
+                'total_seconds': total,
+                'mean_ms': total / count * 1000,
+                'p50_ms': self._bucket_percentile(buckets, count, 50),
+                'p95_ms': self._bucket_percentile(buckets, count, 95),
+                'max_ms': maximum * 1000,
+                'histogram': dict(zip(map(str, METRICS_BUCKETS_MS), buckets)),
+            }
+        return result
+
+    def log_summary(self):
+        """按阶段输出耗时汇总"""
+        logger.warning("处理 %d 个文件 (%d 个出错), 输入 %d 字节, 输出 %d 字节",
+                       self.file_count, self.error_count, self.bytes_in, self.bytes_out)
+        logger.warning("%-10s%8s%10s%10s%10s%10s%10s", '阶段', '次数', '总计s', '平均ms', 'p50≤ms', 'p95≤ms', '最大ms')
+        for stage, item in self.summary().items():
+            logger.warning("%-10s%8d%10.2f%10.1f%10g%10g%10.1f", stage, item['count'], item['total_seconds'],
+                           item['mean_ms'], item['p50_ms'], item['p95_ms'], item['max_ms'])
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    """计算文件内容的哈希值"""
+    import hashlib
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_state(path, with_hash=True):
+    """获取文件的大小、修改时间以及（可选的）内容哈希"""
+    st = os.stat(path)
+    state = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if with_hash:
+        state['hash'] = _file_hash(path)
+    return state
+
+
+class Manifest:
+    """
+    增量处理清单
+
+    按操作分区记录每个文件上次处理后的大小、修改时间、内容哈希以及所用参数。
+    大小和修改时间都未变化时直接跳过；修改时间变化但大小相同时再比较内容哈希，
+    因此只有真正变化过的文件才会被重新读取。
+    """
+
+    version = 1
 
-class ImageProcessor:
     def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.sections = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == self.version:
+                    self.sections = data.get('sections', {})
+            except (OSError, ValueError):
+                # 清单损坏时当作不存在，所有文件都会被重新处理
+                self.sections = {}
+
+    def section(self, name):
+        return self.sections.setdefault(name, {})
+
+    def prune(self, section, filenames):
+        """删除已不存在的文件的记录"""
+        entries = self.section(section)
+        keep = set(filenames)
+        for filename in [name for name in entries if name not in keep]:
+            del entries[filename]
+
+    def is_unchanged(self, section, image_file, settings=None, output_path=None):
+        """
+        判断文件自上次处理后是否未变化
+
+        Args:
+            section: 操作名称
+            image_file: 扫描得到的 ImageFile，直接使用其中的大小和修改时间
+            settings: 本次使用的参数，与上次不同时视为需要重新处理
+            output_path: 输出文件路径，不存在时视为需要重新处理
+        """
+        entry = self.section(section).get(image_file.name)
+        if entry is None or entry.get('settings') != (settings or {}):
+            return False
+        if output_path and not os.path.exists(output_path):
+            return False
+        if image_file.size != entry['size']:
+            return False
+        if image_file.mtime_ns == entry['mtime_ns']:
+            return True
+        # 修改时间变化但大小相同（例如复制或touch），比较内容哈希
+        if entry.get('hash') and _file_hash(image_file.path) == entry['hash']:
+            entry['mtime_ns'] = image_file.mtime_ns
+            return True
+        return False
+
+    def record(self, section, filename, state, settings=None):
+        entry = dict(state)
+        entry['settings'] = settings or {}
+        self.section(section)[filename] = entry
+
+    def move(self, renames):
+        """
+        文件被重命名后，把各操作中的记录一并迁移到新文件名下
+
+        Args:
+            renames: 原文件名 -> 新文件名，整批迁移，互换名称时也不会互相覆盖
+        """
+        for entries in self.sections.values():
+            moved = {}
+            for old_filename, new_filename in renames.items():
+                entry = entries.pop(old_filename, None)
+                if entry is not None:
+                    if entry.get('output') == old_filename:
+                        entry['output'] = new_filename
+                    moved[new_filename] = entry
+            entries.update(moved)
+
+    def save(self):
+        """先写入临时文件再替换，避免中断时留下损坏的清单"""
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.version, 'sections': self.sections}, f)
+        os.replace(temp_path, self.path)
+
+
+class ImageCache:
+    """
+    同一次运行中多个操作共享的图片缓存
+
+    每个条目保存文件内容（data）和已解析的元数据（例如拍摄日期 date），以相对路径为键，
+    并记录文件的大小和修改时间，二者与扫描结果不一致时视为失效。按字节数计入内存预算，
+    超出时淘汰最久未使用的条目；单个文件超过预算时不缓存内容，由处理任务直接读取文件。
+    重命名不改变文件大小和修改时间，由 move() 把条目迁移到新文件名下，因此查找重复、压缩
+    和多尺寸输出先后执行时每个文件只需读取一次。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        """
+        Args:
+            max_bytes: 内存预算（字节），超过预算的单个文件不缓存内容
+        """
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        # 相对路径 -> dict(state, 元数据, data)，按使用顺序排列
+        self.entries = OrderedDict()
+
+    def get(self, image_file):
+        """返回与扫描结果一致的条目，没有时返回None"""
+        entry = self.entries.get(image_file.name)
+        if entry is None:
+            return None
+        if entry['state'] != (image_file.size, image_file.mtime_ns):
+            self.discard(image_file.name)
+            return None
+        self.entries.move_to_end(image_file.name)
+        return entry
+
+    def put(self, image_file, **values):
+        """保存文件内容或元数据，与已有条目合并"""
+        entry = self.get(image_file)
+        if entry is None:
+            entry = self.entries[image_file.name] = {'state': (image_file.size, image_file.mtime_ns)}
+            self.used += CACHE_ENTRY_OVERHEAD
+        data = values.pop('data', None)
+        if data is not None and 'data' not in entry and len(data) + CACHE_ENTRY_OVERHEAD <= self.max_bytes:
+            entry['data'] = data
+            self.used += len(data)
+        entry.update(values)
+        self._evict()
+        return entry
+
+    def fits(self, image_file):
+        """文件内容能否放入内存预算"""
+        return image_file.size + CACHE_ENTRY_OVERHEAD <= self.max_bytes
+
+    def read(self, image_file):
+        """返回文件内容，未缓存时读取文件并缓存；超过内存预算的文件返回None"""
+        entry = self.get(image_file)
+        if entry is not None and 'data' in entry:
+            self.hits += 1
+            return entry['data']
+        self.misses += 1
+        if not self.fits(image_file):
+            return None
+        with open(image_file.path, 'rb') as f:
+            data = f.read()
+        self.put(image_file, data=data)
+        return data
+
+    def discard(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.used -= CACHE_ENTRY_OVERHEAD + len(entry.get('data', b''))
+
+    def move(self, renames):
+        """文件被重命名后，把条目整批迁移到新文件名下"""
+        moved = {}
+        for old_filename, new_filename in renames.items():
+            entry = self.entries.pop(old_filename, None)
+            if entry is not None:
+                moved[new_filename] = entry
+        for new_filename, entry in moved.items():
+            self.discard(new_filename)
+            self.entries[new_filename] = entry
+
+    def _evict(self):
+        while self.used > self.max_bytes and self.entries:
+            self.discard(next(iter(self.entries)))
+
+
+class HashIndex:
+    """
+    按汉明距离查找感知哈希的多索引哈希表
+
+    把 DHASH_SIZE * DHASH_SIZE 位的哈希分成 max_distance + 1 段，每段各建一个哈希表。
+    两个哈希的距离不超过 max_distance 时至少有一段完全相同（抽屉原理），因此查询时
+    只需比较与其某一段相同的候选，而不是全部图片。数十万张图片时每次查询只比较
+    很少一部分候选。
+    """
+
+    def __init__(self, max_distance=DEDUP_DISTANCE, bits=DHASH_SIZE * DHASH_SIZE):
+        self.max_distance = max_distance
+        count = min(max_distance + 1, bits)
+        # 各段的 (起始位, 掩码)，位数尽量平均
+        self.segments = []
+        offset = 0
+        for i in range(count):
+            width = bits // count + (1 if i < bits % count else 0)
+            self.segments.append((offset, (1 << width) - 1))
+            offset += width
+        self.tables = [{} for _ in self.segments]
+        self.size = 0
+
+    def add(self, value, item):
+        """插入哈希值 value，item 为对应的图片"""
+        entry = (value, item)
+        for (offset, mask), table in zip(self.segments, self.tables):
+            table.setdefault(value >> offset & mask, []).append(entry)
+        self.size += 1
+
+    def search(self, value):
+        """返回与 value 的汉明距离不超过 max_distance 的 (距离, 图片) 列表"""
+        results = []
+        checked = set()
+        for (offset, mask), table in zip(self.segments, self.tables):
+            for entry in table.get(value >> offset & mask, ()):
+                if id(entry) in checked:
+                    continue
+                checked.add(id(entry))
+                distance = _hamming(value, entry[0])
+                if distance <= self.max_distance:
+                    results.append((distance, entry[1]))
+        return results
+
+
+class Journal:
+    """
+    断点恢复日志
+
+    每完成一个文件就追加一行并立即刷新，进程被终止时已完成的记录不会丢失。
+    以 resume=True 打开且日志中记录的参数与本次相同时，跳过其中已完成的文件；
+    整批处理正常结束后删除日志。
+    """
+
+    def __init__(self, directory, operation, settings, resume=False):
+        """
+        Args:
+            directory: 保存日志的目录
+            operation: 操作名称，不同操作使用各自的日志
+            settings: 本次使用的参数，与日志中记录的不同时不能恢复
+            resume: 是否从已有的日志恢复
+        """
+        self.path = os.path.join(directory, f"{JOURNAL_NAME}.{operation}.jsonl")
+        self.completed = set()
+        header = {'operation': operation, 'settings': settings}
+
+        resumed = False
+        if resume and os.path.exists(self.path):
+            resumed = self._load(header)
+            if not resumed:
+                logger.warning("日志 %s 与本次参数不同，重新开始处理", self.path)
+
+        self._file = open(self.path, 'a' if resumed else 'w', encoding='utf-8')
+        if not resumed:
+            self._file.write(json.dumps(header, ensure_ascii=False) + '\n')
+            self._file.flush()
+        elif self.completed:
+            logger.info("从日志恢复，跳过 %d 个已完成的文件", len(self.completed))
+
+    def _load(self, header):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        try:
+            if not lines or json.loads(lines[0]) != json.loads(json.dumps(header)):
+                return False
+        except ValueError:
+            return False
+        for line in lines[1:]:
+            try:
+                self.completed.add(json.loads(line))
+            except ValueError:
+                # 进程被终止时最后一行可能不完整
+                continue
+        return True
+
+    def is_done(self, filename):
+        return filename in self.completed
+
+    def mark(self, filename):
+        self.completed.add(filename)
+        self._file.write(json.dumps(filename, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self, finished=False):
+        """关闭日志，整批处理正常结束时删除日志文件"""
+        self._file.close()
+        if finished:
+            os.remove(self.path)
+
+
+def is_archive_path(path):
+    """根据扩展名判断路径是否为支持的压缩包"""
+    return path.lower().endswith(tuple(ARCHIVE_FORMATS))
+
+
+def iter_archive(path):
+    """
+    按顺序逐个读取压缩包中的普通文件成员
+
+    tar 以流方式读取，zip 逐个解压成员，任何时刻只有当前成员的内容在内存中。
+    目录、链接以及会写到目标目录之外的成员名（绝对路径或包含 ..）会被跳过。
+
+    Yields:
+        tuple: (成员名, 修改时间（纳秒）, 内容)
+    """
+    import tarfile
+    import zipfile
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not _safe_member_name(info.filename):
+                    continue
+                mtime_ns = int(datetime(*info.date_time).timestamp() * 1e9)
+                yield info.filename, mtime_ns, archive.read(info)
+    else:
+        with tarfile.open(path, 'r|*') as archive:
+            for member in archive:
+                if not member.isfile() or not _safe_member_name(member.name):
+                    continue
+                yield member.name, int(member.mtime * 1e9), archive.extractfile(member).read()
+
+
+def _list_archive(path):
+    """压缩包中所有普通文件成员的名称（只读取目录，不解压内容）"""
+    import tarfile
+    import zipfile
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return {info.filename for info in archive.infolist() if not info.is_dir()}
+    with tarfile.open(path) as archive:
+        return {member.name for member in archive.getmembers() if member.isfile()}
+
+
+def _safe_member_name(name):
+    normalized = posixpath.normpath(name)
+    if name.startswith('/') or normalized == '..' or normalized.startswith('../'):
+        logger.warning("跳过压缩包中的不安全路径: %s", name)
+        return False
+    return True
+
+
+class ArchiveWriter:
+    """
+    逐个写入成员的输出压缩包
+
+    先写入同一目录下的临时文件，close(commit=True) 时再原子地替换目标文件，
+    因此可以安全地重写正在读取的源压缩包。作为上下文管理器使用时，
+    只有正常退出才会替换目标文件。
+    """
+
+    def __init__(self, path):
+        import tarfile
+        import zipfile
+        self.path = path
+        self.temp_path = os.path.join(os.path.dirname(path) or '.',
+                                      f".{os.path.basename(path)}.{os.urandom(16).hex()}.tmp")
+        mode = next(mode for ext, mode in ARCHIVE_FORMATS.items() if path.lower().endswith(ext))
+        if path.lower().endswith('.zip'):
+            self._zip = zipfile.ZipFile(self.temp_path, 'w')
+            self._tar = None
+        else:
+            self._zip = None
+            self._tar = tarfile.open(self.temp_path, mode)
+        self.names = set()
+
+    def add(self, name, data, mtime_ns=None):
+        """写入一个成员，图片本身已经压缩过，zip 中不再压缩。同名成员只保留先写入的一个"""
+        if name in self.names:
+            logger.warning("压缩包中已有 %s，跳过", name)
+            return
+        self.names.add(name)
+        mtime = mtime_ns / 1e9 if mtime_ns is not None else time.time()
+        import tarfile
+        import zipfile
+        if self._zip is not None:
+            # zip 不能表示 1980 年之前的时间
+            info = zipfile.ZipInfo(name, date_time=max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+            is_image = name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))
+            info.compress_type = zipfile.ZIP_STORED if is_image else zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self._zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            self._tar.addfile(info, io.BytesIO(data))
+
+    def close(self, commit=True):
+        archive = self._zip if self._zip is not None else self._tar
+        archive.close()
+        if not commit:
+            os.remove(self.temp_path)
+            return
+        with open(self.temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(self.temp_path, self.path)
+        _fsync_directory(os.path.dirname(self.path) or '.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(commit=exc_type is None)
+
+
+class _NameAllocator:
+    """
+    在已占用的名称集合中分配不冲突的名称
+
+    名称被占用时依次尝试 name_1、name_2 等，并记住每个名称下一次尝试的后缀，
+    同一时间拍摄的大量图片也不会反复从 _1 开始探测。
+    """
+
+    def __init__(self, occupied):
+        self.occupied = occupied
+        self.next_suffix = {}
+
+    def allocate(self, name):
+        if name in self.occupied:
+            stem, ext = os.path.splitext(name)
+            counter = self.next_suffix.get(name, 1)
+            while f"{stem}_{counter}{ext}" in self.occupied:
+                counter += 1
+            self.next_suffix[name] = counter + 1
+            name = f"{stem}_{counter}{ext}"
+        self.occupied.add(name)
+        return name
+
+
+def plan_renames(targets, existing, on_conflict='suffix'):
+    """
+    计算一批文件的重命名方案
+
+    只在内存中的名称集合上计算，不访问文件系统。本批中要被改名的文件，其原名称视为可用，
+    因此重复运行、互换名称或循环重命名都能得到完整的方案（执行时经过临时名称，参见
+    ImageProcessor._apply_renames）。
+
+    Args:
+        targets: 原名称 -> 期望的新名称，按优先顺序排列
+        existing: 相关目录中已有的全部名称
+        on_conflict: 期望的名称被其他文件占用时的处理方式：'suffix' 依次加上 _1、_2 等后缀，
+            'skip' 跳过该文件（保留原名称）
+
+    Returns:
+        dict: 原名称 -> 新名称，只包含名称确实改变的文件
+    """
+    # 不改名的文件继续占用原名称
+    staying = {old for old, new in targets.items() if new == old}
+    occupied = (set(existing) - set(targets)) | staying
+
+    if on_conflict == 'suffix':
+        allocator = _NameAllocator(occupied)
+        plan = {}
+        for old, new in targets.items():
+            if old not in staying:
+                plan[old] = allocator.allocate(new)
+        return {old: new for old, new in plan.items() if new != old}
+
+    # skip：被跳过的文件保留原名称，若该名称已分配给其他文件，那个文件也要跳过
+    owners = {}
+    pending = []
+    for old, new in targets.items():
+        if old in staying:
+            continue
+        if new in occupied or new in owners:
+            logger.info("跳过 %s，因为 %s 已存在", old, new)
+            pending.append(old)
+        else:
+            owners[new] = old
+    while pending:
+        name = pending.pop()
+        occupied.add(name)
+        victim = owners.pop(name, None)
+        if victim is not None:
+            logger.info("跳过 %s，因为 %s 已存在", victim, name)
+            pending.append(victim)
+    return {old: new for new, old in owners.items()}
+
+
+def _write_undo_log(path, operation, entries, phase):
+    """写入重命名撤销日志：entries 为 (原名称, 临时名称, 新名称)，phase 为正在执行的阶段"""
+    data = json.dumps({'operation': operation, 'phase': phase, 'entries': entries}, ensure_ascii=False)
+    _write_file(path, data.encode('utf-8'))
+
+
+class ImageProcessor:
+    def __init__(self, directory, recursive=False, include=None, exclude=None, metrics=None,
+                 progress=None, cancel_event=None, cache=None, memory_limit=None, pool=None):
+        """
+        Args:
+            directory: 图片目录路径，也可以是 zip/tar 压缩包（此时处理包中所有子目录的图片）
+            recursive: 是否递归处理子目录
+            include: 只处理匹配这些通配符的文件（匹配相对路径，例如 "*.jpg"、"2023/*"）
+            exclude: 跳过匹配这些通配符的文件或子目录
+            metrics: Metrics 实例，指定后记录每个文件各处理阶段的耗时
+            progress: 进度回调 progress(operation, filename)，每处理（或跳过）一个文件调用一次
+            cancel_event: 取消标志（例如 threading.Event），被设置后在处理完当前文件后停止
+            cache: ImageCache 实例，指定后各操作共享已读取的文件内容和拍摄日期，
+                同一实例执行多个操作时每个文件只需读取一次（来源为压缩包时不使用）
+            memory_limit: 并行处理时的内存上限（字节）。按估算的内存占用而不是文件数提交任务，
+                同时处理的图片估算总量不超过该值，并限制每个工作进程的内存，参见 _run_in_pool
+            pool: 共享的进程池（WorkerPool），指定后并行处理时不再每次启动新的工作进程，
+                依次处理多个目录时可以省去进程池的启动时间
+        """
         self.directory = directory
         self.supported_formats = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
+        self.recursive = recursive
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.metrics = metrics
+        self.progress = progress
+        self.cancel_event = cancel_event
+        self.archive = is_archive_path(directory) and os.path.isfile(directory)
+        # 压缩包成员的内容本身就在内存中，无需缓存
+        self.cache = cache if not self.archive else None
+        self.memory_limit = memory_limit
+        self.pool = pool
+
+    def _cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            logger.warning("处理已取消")
+            return True
+        return False
+
+    def _load(self, image_file):
+        """有缓存时读取文件内容（已缓存时直接使用），随 ImageFile.data 交给处理任务
+
+        超过缓存预算的文件不读入主进程，只传递路径，由处理任务自己读取。
+        """
+        if self.cache is None or image_file.data is not None:
+            return image_file
+        data = self.cache.read(image_file)
+        return image_file if data is None else image_file._replace(data=data)
+
+    def _compress_cost(self, options):
+        """压缩单个文件的内存估算函数，供 _run_in_pool 按内存提交任务"""
+        def cost(image_file):
+            return _estimate_memory(image_file, options['max_width'], options['max_height'],
+                                    RESIZE_MODES[options['resize_mode']])
+        return cost
+
+    def _notify(self, operation, filename):
+        if self.progress:
+            self.progress(operation, filename)
+
+    def _matches(self, relative_path, patterns):
+        relative_path = relative_path.replace(os.sep, '/')
+        return any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns)
+
+    def iter_image_files(self, exclude_dirs=()):
+        """
+        逐个产生目录中支持的图片文件
+
+        基于 os.scandir 扫描，每个目录读取完目录项后即开始产生文件，调用方可以在扫描其余
+        目录的同时处理已经得到的文件。文件大小和修改时间取自扫描时的 DirEntry，后续无需再次stat。
+        同一目录的目录项会先全部读出，因此原地处理时新生成的文件不会在本次扫描中再次出现。
+        递归时会进入指向目录的符号链接，但每个实际目录只扫描一次，链接成环时不会重复产生文件；
+        无法读取的目录记录错误后跳过。
+
+        Args:
+            exclude_dirs: 不进入的目录（例如位于图片目录内的输出目录）
+
+        Yields:
+            ImageFile: 图片文件
+        """
+        if self.archive:
+            yield from self._iter_archive_images()
+            return
+
+        excluded = {os.path.realpath(path) for path in exclude_dirs}
+        visited = {os.path.realpath(self.directory)}
+        pending_dirs = ['']
+        while pending_dirs:
+            relative_dir = pending_dirs.pop()
+            try:
+                with os.scandir(os.path.join(self.directory, relative_dir)) as it:
+                    entries = list(it)
+            except OSError as e:
+                if not relative_dir:
+                    raise
+                logger.error("无法读取目录 %s: %s", relative_dir, e)
+                continue
+
+            subdirs = []
+            for entry in entries:
+                relative_path = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+                if self._matches(relative_path, self.exclude):
+                    continue
+                if entry.is_dir():
+                    if self.recursive:
+                        real_path = os.path.realpath(entry.path)
+                        if real_path not in excluded and real_path not in visited:
+                            visited.add(real_path)
+                            subdirs.append(relative_path)
+                    continue
+                if not entry.name.lower().endswith(self.supported_formats) or not entry.is_file():
+                    continue
+                if self.include and not self._matches(relative_path, self.include):
+                    continue
+                st = entry.stat()
+                yield ImageFile(relative_path, entry.path, st.st_size, st.st_mtime_ns)
+
+            # 倒序入栈，使子目录按扫描到的顺序处理
+            pending_dirs.extend(reversed(subdirs))
+
+    def _iter_archive_images(self):
+        """逐个产生压缩包中的图片成员，内容随 ImageFile.data 一起返回"""
+        for name, mtime_ns, data in iter_archive(self.directory):
+            if self._is_archive_image(name):
+                yield ImageFile(name, os.path.join(self.directory, name), len(data), mtime_ns, data)
+
+    def _is_archive_image(self, name):
+        if not name.lower().endswith(self.supported_formats):
+            return False
+        # 与扫描目录时一样，排除规则也作用于成员所在的各级子目录
+        parts = name.split('/')
+        if any(self._matches('/'.join(parts[:i]), self.exclude) for i in range(1, len(parts) + 1)):
+            return False
+        return not self.include or self._matches(name, self.include)
 
     def get_image_files(self):
-        """获取目录中所有支持的图片文件"""
-        image_files = []
-        for filename in os.listdir(self.directory):
-            if filename.lower().endswith(self.supported_formats):
-                image_files.append(filename)
-        return sorted(image_files)
+        """获取目录中所有支持的图片文件（相对路径，已排序）"""
+        if self.archive:
+            # 只读取压缩包目录，不解压成员内容
+            return sorted(name for name in _list_archive(self.directory) if self._is_archive_image(name))
+        return sorted(image_file.name for image_file in self.iter_image_files())
 
-    def rename_images(self, pattern, start_number=1):
+    def rename_images(self, pattern, start_number=1, dry_run=False):
         """
         批量重命名图片
+
+        先计算出完整的重命名方案再执行，目标名称被本批中其他图片占用（例如重复运行或
+        改变起始编号）时也能正确处理，参见 plan_renames。
         
         Args:
             pattern: 命名模式，例如 "image_" 将文件重命名为 image_1, image_2, ...
             start_number: 起始编号
+            dry_run: 只输出重命名方案，不修改文件
         """
-        image_files = self.get_image_files()
-        renamed_count = 0
+        # 压缩包的成员名总是以 / 分隔
+        path_module = posixpath if self.archive else os.path
+        targets = {}
+        for i, filename in enumerate(self.get_image_files(), start=start_number):
+            file_extension = path_module.splitext(filename)[1].lower()
+            # 根据模式生成新文件名（递归处理时保留在原子目录中）
+            targets[filename] = path_module.join(path_module.dirname(filename), f"{pattern}{i}{file_extension}")
 
-        for i, filename in enumerate(image_files, start=start_number):
-            old_path = os.path.join(self.directory, filename)
-            file_extension = os.path.splitext(filename)[1].lower()
-            
-            # 根据模式生成新文件名
-            new_filename = f"{pattern}{i}{file_extension}"
-            new_path = os.path.join(self.directory, new_filename)
-            
-            # 如果新文件名已存在，则跳过
-            if os.path.exists(new_path):
-                print(f"跳过 {filename}，因为 {new_filename} 已存在")
-                continue
-                
-            os.rename(old_path, new_path)
-            print(f"重命名: {filename} -> {new_filename}")
-            renamed_count += 1
-            
-        return renamed_count
+        if self.archive:
+            plan = plan_renames(targets, _list_archive(self.directory), on_conflict='skip')
+            return self._rename_archive('rename', lambda image_file, taken: plan.get(image_file.name), dry_run)
 
-    def rename_images_by_date(self):
+        plan = plan_renames(targets, self._scan_names(targets), on_conflict='skip')
+        # 不需要改名的文件直接计入进度，其余文件在重命名后计入
+        for filename in targets:
+            if filename not in plan:
+                self._notify('rename', filename)
+        return self._apply_renames('rename', plan, dry_run, notify=True)
+
+    def rename_images_by_date(self, incremental=False, dry_run=False):
         """
         根据图片的拍摄日期重命名图片
+
+        先读取全部图片的拍摄日期，再统一计算重命名方案并执行。同一时间拍摄的多张图片
+        依次加上 _1、_2 等后缀。
+
+        Args:
+            incremental: 是否启用增量模式，跳过上次已按日期重命名且未变化的文件（不支持压缩包）
+            dry_run: 只输出重命名方案，不修改文件
         """
-        image_files = self.get_image_files()
-        renamed_count = 0
+        if self.archive:
+            if incremental:
+                raise ValueError("压缩包不支持增量处理")
+            allocator = None
+
+            def new_name(image_file, taken):
+                nonlocal allocator
+                if allocator is None:
+                    allocator = _NameAllocator(taken)
+                filename = image_file.name
+                date_str = self.get_capture_date(image_file.data, image_file.mtime_ns / 1e9)
+                if not date_str:
+                    logger.warning("无法获取 %s 的拍摄日期，跳过", filename)
+                    return None
+                file_extension = posixpath.splitext(filename)[1].lower()
+                target = posixpath.join(posixpath.dirname(filename), date_str + file_extension)
+                # 自身的原名称可以继续使用
+                taken.discard(filename)
+                return allocator.allocate(target)
 
-        for filename in image_files:
+            return self._rename_archive('rename_by_date', new_name, dry_run)
+
+        # 重命名会修改目录内容，因此先完整扫描再处理
+        image_files = sorted(self.iter_image_files())
+        skipped_count = 0
+
+        manifest = None
+        if incremental:
+            manifest = Manifest(self.directory)
+            manifest.prune('rename_by_date', [image_file.name for image_file in image_files])
+
+        targets = {}
+        for image_file in image_files:
+            if self._cancelled():
+                # 尚未修改任何文件
+                return 0
+            filename = image_file.name
+            self._notify('rename_by_date', filename)
             old_path = os.path.join(self.directory, filename)
+            if manifest and manifest.is_unchanged('rename_by_date', image_file):
+                skipped_count += 1
+                continue
+            stats = {'filename': filename, 'old_size': image_file.size, 'error': None}
+            timer = _StageTimer(stats.setdefault('stages', {}) if self.metrics else None)
+            start = time.perf_counter()
             try:
-                # 尝试获取拍摄日期
-                date_str = self.get_capture_date(old_path)
+                # 尝试获取拍摄日期，只读取文件头部；已缓存的日期直接使用
+                entry = self.cache.get(image_file) if self.cache else None
+                if entry is not None and 'date' in entry:
+                    date_str = entry['date']
+                elif entry is not None and 'data' in entry:
+                    with timer.stage('read_date'):
+                        date_str = self.get_capture_date(entry['data'], image_file.mtime_ns / 1e9)
+                else:
+                    with timer.stage('read_date'):
+                        date_str = self.get_capture_date(old_path, image_file.mtime_ns / 1e9)
+                    if self.cache:
+                        self.cache.put(image_file, date=date_str)
                 if date_str:
                     file_extension = os.path.splitext(filename)[1].lower()
-                    new_filename = f"{date_str}{file_extension}"
-                    new_path = os.path.join(self.directory, new_filename)
-                    
-                    # 检查文件名是否已存在
-                    counter = 1
-                    final_filename = new_filename
-                    final_path = new_path
-                    while os.path.exists(final_path) and final_path != old_path:
-                        name_without_ext = os.path.splitext(new_filename)[0]
-                        final_filename = f"{name_without_ext}_{counter}{file_extension}"
-                        final_path = os.path.join(self.directory, final_filename)
-                        counter += 1
-                    
-                    if final_path != old_path:
-                        os.rename(old_path, final_path)
-                        print(f"重命名: {filename} -> {final_filename}")
-                        renamed_count += 1
+                    targets[filename] = os.path.join(os.path.dirname(filename), f"{date_str}{file_extension}")
                 else:
-                    print(f"无法获取 {filename} 的拍摄日期，跳过")
+                    logger.warning("无法获取 %s 的拍摄日期，跳过", filename)
             except Exception as e:
-                print(f"处理 {filename} 时出错: {e}")
+                stats['error'] = str(e)
+                logger.error("处理 %s 时出错: %s", filename, e)
+            if self.metrics:
+                stats['seconds'] = time.perf_counter() - start
+                self.metrics.add('rename_by_date', stats)
+
+        plan = plan_renames(targets, self._scan_names(targets), on_conflict='suffix')
+        renamed_count = self._apply_renames('rename_by_date', plan, dry_run, manifest=manifest)
+
+        if manifest and not dry_run:
+            for filename in targets:
+                final_filename = plan.get(filename, filename)
+                # 重命名不改变大小和修改时间，无需计算内容哈希
+                manifest.record('rename_by_date', final_filename,
+                                _file_state(os.path.join(self.directory, final_filename), with_hash=False))
+            manifest.save()
+        if skipped_count:
+            logger.info("跳过 %d 个未变化的文件", skipped_count)
                 
         return renamed_count
 
-    def get_capture_date(self, image_path):
+    def _scan_names(self, filenames):
+        """一次性读取这些文件所在各目录中的全部名称（包括非图片文件和子目录）"""
+        names = set()
+        for relative_dir in {os.path.dirname(filename) for filename in filenames}:
+            for name in os.listdir(os.path.join(self.directory, relative_dir)):
+                names.add(os.path.join(relative_dir, name) if relative_dir else name)
+        return names
+
+    def _apply_renames(self, operation, plan, dry_run=False, manifest=None, notify=False):
+        """
+        执行重命名方案
+
+        分两个阶段执行：先把所有文件改为临时名称，再改为目标名称，因此互换名称或循环
+        重命名也不会互相覆盖。执行前写入撤销日志并在两阶段之间更新，中途失败时自动
+        恢复；进程被终止时可以用 undo_renames 恢复。上一次重命名被终止、还有文件停留在
+        临时名称时拒绝执行，避免覆盖其撤销日志。
+        完成后把增量处理清单中的记录迁移到新文件名下：指定 manifest 时迁移该清单
+        （由调用方保存），否则迁移并保存图片目录中已有的清单，之后的增量处理不会把
+        改名后的文件当作新文件重新压缩。notify 为真时每重命名一个文件调用一次进度回调
+        （调用方已在读取日期等阶段报告进度时不需要）。
+
+        Returns:
+            int: 重命名的文件数
+        """
+        if dry_run:
+            for old_filename, new_filename in plan.items():
+                logger.info("计划重命名: %s -> %s", old_filename, new_filename)
+            return len(plan)
+        if not plan:
+            return 0
+        undo_log = os.path.join(self.directory, RENAME_UNDO_NAME)
+        if self._unfinished_renames(undo_log):
+            raise ValueError("上一次重命名没有完成，请先撤销重命名（--undo-rename）恢复原文件名")
+
+        token = os.urandom(4).hex()
+        entries = [(old_filename, os.path.join(os.path.dirname(old_filename), f".{token}.{i}.renaming"), new_filename)
+                   for i, (old_filename, new_filename) in enumerate(plan.items())]
+        _write_undo_log(undo_log, operation, entries, phase=1)
+        try:
+            for old_filename, temp_filename, _ in entries:
+                os.rename(os.path.join(self.directory, old_filename), os.path.join(self.directory, temp_filename))
+            _write_undo_log(undo_log, operation, entries, phase=2)
+            for old_filename, temp_filename, new_filename in entries:
+                os.rename(os.path.join(self.directory, temp_filename), os.path.join(self.directory, new_filename))
+                logger.info("重命名: %s -> %s", old_filename, new_filename)
+                if notify:
+                    self._notify(operation, old_filename)
+        except OSError as e:
+            logger.error("重命名时出错: %s，正在恢复原文件名", e)
+            self.undo_renames()
+            raise
+        if manifest is not None:
+            manifest.move(plan)
+        elif os.path.exists(os.path.join(self.directory, MANIFEST_NAME)):
+            manifest = Manifest(self.directory)
+            manifest.move(plan)
+            manifest.save()
+        if self.cache:
+            self.cache.move(plan)
+        return len(entries)
+
+    def _unfinished_renames(self, undo_log):
+        """撤销日志中是否还有文件停留在临时名称（上一次重命名在执行过程中被终止）"""
+        if not os.path.exists(undo_log):
+            return False
+        with open(undo_log, 'r', encoding='utf-8') as f:
+            log = json.load(f)
+        return any(os.path.exists(os.path.join(self.directory, temp_filename))
+                   for _, temp_filename, _ in log['entries'])
+
+    def undo_renames(self):
+        """
+        撤销最近一次重命名（包括中途被终止的重命名）
+
+        Returns:
+            int: 恢复原名称的文件数，没有撤销日志时返回0
+        """
+        undo_log = os.path.join(self.directory, RENAME_UNDO_NAME)
+        if not os.path.exists(undo_log):
+            logger.warning("没有可撤销的重命名")
+            return 0
+        with open(undo_log, 'r', encoding='utf-8') as f:
+            log = json.load(f)
+
+        def path(name):
+            return os.path.join(self.directory, name)
+
+        # 第一阶段完成后文件只会位于临时名称或目标名称，先全部移回临时名称
+        if log['phase'] == 2:
+            for _, temp_filename, new_filename in log['entries']:
+                if not os.path.exists(path(temp_filename)) and os.path.exists(path(new_filename)):
+                    os.rename(path(new_filename), path(temp_filename))
+        restored = 0
+        for old_filename, temp_filename, _ in log['entries']:
+            if os.path.exists(path(temp_filename)):
+                os.rename(path(temp_filename), path(old_filename))
+                restored += 1
+        renames = {new_filename: old_filename for old_filename, _, new_filename in log['entries']}
+        if os.path.exists(os.path.join(self.directory, MANIFEST_NAME)):
+            manifest = Manifest(self.directory)
+            manifest.move(renames)
+            manifest.save()
+        if self.cache:
+            self.cache.move(renames)
+        os.remove(undo_log)
+        logger.info("已恢复 %d 个文件的原名称", restored)
+        return restored
+
+    def _rename_archive(self, operation, new_name, dry_run=False):
+        """
+        重写压缩包以重命名其中的图片
+
+        按顺序流式读取各成员并写入新的压缩包，图片成员使用 new_name(image_file, taken)
+        返回的名称（返回None或原名称时保持不变），taken 为当前已占用的全部成员名。
+        其他成员原样保留。全部写完后才替换原压缩包，取消或出错时原压缩包保持不变。
+        dry_run 为真时只输出重命名方案。
+        """
+        taken = _list_archive(self.directory)
+        renamed_count = 0
+        writer = ArchiveWriter(self.directory) if not dry_run else None
+        finished = False
+        try:
+            for name, mtime_ns, data in iter_archive(self.directory):
+                if self._is_archive_image(name):
+                    if self._cancelled():
+                        return 0
+                    self._notify(operation, name)
+                    image_file = ImageFile(name, os.path.join(self.directory, name), len(data), mtime_ns, data)
+                    try:
+                        final_name = new_name(image_file, taken)
+                    except Exception as e:
+                        logger.error("处理 %s 时出错: %s", name, e)
+                        final_name = None
+                    if final_name and final_name != name:
+                        taken.discard(name)
+                        taken.add(final_name)
+                        logger.info("计划重命名: %s -> %s" if dry_run else "重命名: %s -> %s", name, final_name)
+                        renamed_count += 1
+                        name = final_name
+                if writer:
+                    writer.add(name, data, mtime_ns)
+            finished = True
+        finally:
+            if writer:
+                writer.close(commit=finished)
+        return renamed_count
+
+    def get_capture_date(self, image_path, mtime=None):
         """
         从图片EXIF数据中获取拍摄日期
+
+        JPEG和TIFF文件直接读取文件头中的EXIF数据，不经过Pillow解析整张图片；
+        其他格式或文件头无法解析时再使用Pillow读取。
         
         Args:
-            image_path: 图片文件路径
+            image_path: 图片文件路径，或压缩包成员的内容（bytes）
+            mtime: 文件修改时间（秒），EXIF中没有日期时使用；为None时从文件获取
             
         Returns:
             str: 格式化的日期字符串，如果无法获取则返回None
         """
         try:
-            image = Image.open(image_path)
-            exifdata = image.getexif()
-            
-            if exifdata is not None:
-                for tag_id in exifdata:
-                    tag = TAGS.get(tag_id, tag_id)
-                    if tag == "DateTimeOriginal" or tag == "DateTime":
-                        date_str = str(exifdata[tag_id])
-                        # 转换为更友好的格式 YYYYMMDD_HHMMSS
-                        dt = datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
-                        return dt.strftime("%Y%m%d_%H%M%S")
+            try:
+                date_str = _read_exif_date(image_path)
+            except (ValueError, struct.error):
+                date_str = _read_exif_date_pillow(image_path)
+
+            if date_str:
+                # 转换为更友好的格式 YYYYMMDD_HHMMSS
+                dt = datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
+                return dt.strftime("%Y%m%d_%H%M%S")
             
             # 如果EXIF中没有日期信息，使用文件修改时间
-            mtime = os.path.getmtime(image_path)
+            if mtime is None:
+                mtime = os.path.getmtime(image_path)
             dt = datetime.fromtimestamp(mtime)
             return dt.strftime("%Y%m%d_%H%M%S")
         except Exception:
             return None
 
-    def compress_images(self, quality=85, max_width=1920, max_height=1080, output_dir=None):
+    def find_duplicates(self, max_distance=DEDUP_DISTANCE, workers=1, manifest=None, exclude_dirs=()):
+        """
+        查找近似重复的图片
+
+        为每张图片计算感知哈希（dHash），按文件名顺序插入 HashIndex，与已有图片的距离不超过
+        max_distance 的视为重复，对应到最先出现的那张图片。哈希值保存在图片目录的清单中，
+        文件未变化时不再重新解码。
+
+        Args:
+            max_distance: 视为重复的最大汉明距离
+            workers: 计算哈希的并行进程数，0 表示使用全部CPU核心
+            manifest: 保存哈希值的清单，为None时使用图片目录中的清单并在结束后保存
+            exclude_dirs: 不进入的目录
+
+        Returns:
+            dict: 重复图片 -> 原图
+        """
+        # 来源为压缩包时不保存哈希值
+        save_manifest = manifest is None and not self.archive
+        if manifest is None:
+            manifest = Manifest(self.directory)
+        entries = manifest.section('dhash')
+        hashes = {}
+        cancelled = False
+
+        def iter_jobs():
+            nonlocal cancelled
+            for image_file in self.iter_image_files(exclude_dirs=exclude_dirs):
+                if self._cancelled():
+                    cancelled = True
+                    return
+                if manifest.is_unchanged('dhash', image_file):
+                    hashes[image_file.name] = int(entries[image_file.name]['dhash'], 16)
+                    continue
+                yield self._load(image_file)
+
+        if not workers:
+            workers = os.cpu_count() or 1
+        if workers > 1:
+            results = _run_in_pool(_hash_file, iter_jobs(), {}, workers, self.memory_limit,
+                                   lambda image_file: _estimate_memory(image_file, DHASH_SIZE * 8, DHASH_SIZE * 8, 1.0),
+                                   self.pool)
+        else:
+            results = (_hash_file(image_file, {}) for image_file in iter_jobs())
+
+        for stats in results:
+            if stats['error']:
+                logger.error("计算 %s 的感知哈希时出错: %s", stats['filename'], stats['error'])
+                continue
+            hashes[stats['filename']] = stats['dhash']
+            manifest.record('dhash', stats['filename'],
+                            {'size': stats['size'], 'mtime_ns': stats['mtime_ns'], 'dhash': f"{stats['dhash']:016x}"})
+
+        if not cancelled:
+            manifest.prune('dhash', hashes)
+        if save_manifest:
+            manifest.save()
+
+        # 按文件名顺序建立索引，使每组重复图片中保留的原图是确定的
+        index = HashIndex(max_distance)
+        duplicates = {}
+        for filename in sorted(hashes):
+            value = hashes[filename]
+            matches = index.search(value)
+            if matches:
+                distance, original = min(matches)
+                duplicates[filename] = original
+                logger.info("重复: %s 与 %s 近似 (距离 %d)", filename, original, distance)
+            else:
+                index.add(value, filename)
+        return duplicates
+
+    def compress_images(self, quality=85, max_width=1920, max_height=1080, output_dir=None, workers=1,
+                        resize_mode='balanced', incremental=False, target_size=None, resume=False,
+                        dedup=None, dedup_distance=DEDUP_DISTANCE, background=DEFAULT_BACKGROUND,
+                        output_format=None):
         """
         批量压缩图片
         
@@ -126,138 +1325,1705 @@ class ImageProcessor:
             max_width: 最大宽度
             max_height: 最大高度
             output_dir: 输出目录，如果为None则覆盖原文件
+            workers: 并行进程数，1为串行处理，0或None表示使用全部CPU核心
+            resize_mode: 缩放模式 ('quality', 'balanced', 'fast')，参见 RESIZE_MODES
+            incremental: 是否启用增量模式，跳过上次以相同参数压缩且未变化的文件。
+                处理记录保存在输出目录（原地处理时即图片目录）的清单文件中
+            target_size: 目标文件大小（字节）。指定后对每张输出为JPEG的图片，在 quality 以下
+                二分查找满足大小的最高质量，选用的质量记录在统计信息的 quality 中
+            resume: 是否从上次中断的位置继续，跳过断点恢复日志中已完成的文件
+            dedup: 近似重复图片的处理方式，None 表示不检测，'skip' 不压缩重复图片，
+                'link' 把重复图片硬链接到原图的输出文件（需要指定输出目录）
+            dedup_distance: 视为重复的最大汉明距离，参见 find_duplicates
+            background: 带透明度的图片转换为JPEG时透明部分使用的背景色 (R, G, B)
+            output_format: 输出格式，None 表示PNG在质量为100时保持PNG、其余统一输出为JPEG；
+                'auto' 为每张图片按内容试编码各候选格式并选用最小的结果（参见 _format_candidates），
+                也可以指定 COMPRESS_FORMATS 中的某一种格式。文件扩展名随输出格式改变
+
+        Returns:
+            int: 成功压缩的文件数，每个文件的统计信息保存在 self.compress_stats 中
         """
-        image_files = self.get_image_files()
+        if resize_mode not in RESIZE_MODES:
+            raise ValueError(f"不支持的缩放模式: {resize_mode}")
+        if output_format not in (None,) + COMPRESS_FORMATS:
+            raise ValueError(f"不支持的输出格式: {output_format}")
+        if output_format == 'avif' and not avif_available():
+            raise ValueError("当前Pillow不支持AVIF编码")
+        if target_size and output_format not in (None, 'jpeg'):
+            raise ValueError("目标文件大小只支持JPEG输出")
+
         compressed_count = 0
+        skipped_count = 0
+        self.compress_stats = []
+
+        if dedup not in (None,) + DEDUP_MODES:
+            raise ValueError(f"未知的去重方式: {dedup}")
+        if dedup == 'link' and not output_dir:
+            raise ValueError("硬链接重复图片需要指定输出目录")
+
+        archive_output = None
+        if output_dir and is_archive_path(output_dir):
+            archive_output = output_dir
+        elif self.archive and not output_dir:
+            # 原地处理压缩包时重写整个压缩包
+            archive_output = self.directory
+        if (self.archive or archive_output) and (incremental or resume or dedup):
+            raise ValueError("压缩包不支持增量处理、断点恢复和去重")
 
         # 如果指定了输出目录但不存在，则创建它
+        if output_dir and not archive_output and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        settings = {
+            'quality': quality,
+            'max_width': max_width,
+            'max_height': max_height,
+            'resize_mode': resize_mode,
+            'target_size': target_size,
+        }
+        background = tuple(background)
+        if background != DEFAULT_BACKGROUND:
+            # 只在非默认背景色时记录，已有清单中的记录在默认设置下仍然有效
+            settings['background'] = background
+        if output_format:
+            settings['format'] = output_format
+        options = dict(settings, background=background, output_dir=output_dir, record_state=incremental,
+                       metrics=self.metrics is not None, output_format=output_format)
+        if self.archive or archive_output:
+            return self._compress_archive(options, archive_output, workers)
+
+        manifest = Manifest(output_dir or self.directory) if incremental else None
+        journal = Journal(output_dir or self.directory, 'compress', settings, resume=resume)
+        seen = set()
+
+        duplicates = {}
+        if dedup:
+            # 原地处理时感知哈希与压缩记录共用同一个清单
+            duplicates = self.find_duplicates(dedup_distance, workers,
+                                              manifest=manifest if manifest and not output_dir else None,
+                                              exclude_dirs=[output_dir] if output_dir else ())
+        copies = {}
+        for duplicate, original in duplicates.items():
+            copies.setdefault(original, []).append(duplicate)
+
+        cancelled = False
+
+        def iter_jobs():
+            nonlocal skipped_count, cancelled
+            # 输出目录位于图片目录内时不扫描输出目录
+            for image_file in self.iter_image_files(exclude_dirs=[output_dir] if output_dir else ()):
+                # 取消后不再提交新文件，已在处理中的文件照常完成
+                if self._cancelled():
+                    cancelled = True
+                    return
+                seen.add(image_file.name)
+                if journal.is_done(image_file.name) or image_file.name in duplicates:
+                    self._notify('compress', image_file.name)
+                    continue
+                if manifest:
+                    entry = manifest.section('compress').get(image_file.name)
+                    output_path = None
+                    if output_dir and entry:
+                        output_path = os.path.join(output_dir, entry.get('output', image_file.name))
+                    if manifest.is_unchanged('compress', image_file, settings, output_path):
+                        skipped_count += 1
+                        self._notify('compress', image_file.name)
+                        continue
+                yield self._load(image_file)
+
+        if not workers:
+            workers = os.cpu_count() or 1
+        if workers > 1:
+            results = _run_in_pool(_compress_file, iter_jobs(), options, workers, self.memory_limit,
+                                   self._compress_cost(options), self.pool)
+        else:
+            results = (_compress_file(image_file, options) for image_file in iter_jobs())
+
+        finished = False
+        try:
+            for stats in results:
+                self.compress_stats.append(stats)
+                self._notify('compress', stats['filename'])
+                if self.metrics:
+                    self.metrics.add('compress', stats)
+                if self.cache and not output_dir:
+                    # 原地压缩后源文件已被替换
+                    self.cache.discard(stats['filename'])
+                if _report_compress(stats):
+                    compressed_count += 1
+                    journal.mark(stats['filename'])
+                    if not output_dir and stats['output_name'] != stats['filename']:
+                        # 原地转换产生的新文件（例如PNG转JPEG）在恢复时也不应再被压缩
+                        journal.mark(stats['output_name'])
+                    if manifest:
+                        _record_compress(manifest, stats, settings, output_dir)
+                        seen.add(stats['output_name'])
+                        entry = manifest.section('dhash').get(stats['filename'])
+                        if dedup and not output_dir and entry:
+                            # 原地压缩后沿用压缩前的感知哈希，重复关系不会因重新压缩而改变
+                            entry.update(stats['source_state'])
+                    if dedup == 'link':
+                        for duplicate in copies.get(stats['filename'], ()):
+                            _link_duplicate(stats, duplicate, output_dir)
+            # 取消时保留断点恢复日志，之后可以用 resume 继续
+            finished = not cancelled
+        finally:
+            journal.close(finished)
+            if manifest:
+                # 中断时 seen 只包含已扫描到的文件，不能据此删除其余文件的记录
+                if finished:
+                    manifest.prune('compress', seen)
+                manifest.save()
+
+        _report_format_savings(self.compress_stats)
+        if skipped_count:
+            logger.info("跳过 %d 个未变化的文件", skipped_count)
+        if duplicates:
+            logger.info("跳过 %d 个重复的图片", len(duplicates))
+        
+        return compressed_count
+
+    def _compress_archive(self, options, archive_output, workers):
+        """
+        压缩来源或输出为压缩包的图片
+
+        图片成员以流的方式读出并交给压缩任务，编码结果按完成顺序直接写入输出压缩包，
+        不经过临时目录；同时在途的成员数由 _run_in_pool 限制，内存占用有上限。
+        重写源压缩包时其他成员原样保留，压缩失败的图片保留原内容。
+
+        Args:
+            options: 压缩参数，参见 _compress_file
+            archive_output: 输出压缩包路径，为None时输出到 options['output_dir'] 目录
+            workers: 并行进程数
+        """
+        compressed_count = 0
+        writer = ArchiveWriter(archive_output) if archive_output else None
+        options = dict(options, archive_output=writer is not None)
+        in_place = archive_output == self.directory
+        pending = {}
+        cancelled = False
+
+        def iter_jobs():
+            nonlocal cancelled
+            if not self.archive:
+                for image_file in self.iter_image_files():
+                    if self._cancelled():
+                        cancelled = True
+                        return
+                    yield image_file
+                return
+            for name, mtime_ns, data in iter_archive(self.directory):
+                if not self._is_archive_image(name):
+                    if in_place:
+                        writer.add(name, data, mtime_ns)
+                    continue
+                if self._cancelled():
+                    cancelled = True
+                    return
+                image_file = ImageFile(name, os.path.join(self.directory, name), len(data), mtime_ns, data)
+                if in_place:
+                    # 压缩失败时需要把原内容写回
+                    pending[name] = image_file
+                yield image_file
+
+        if not workers:
+            workers = os.cpu_count() or 1
+        if workers > 1:
+            results = _run_in_pool(_compress_file, iter_jobs(), options, workers, self.memory_limit,
+                                   self._compress_cost(options), self.pool)
+        else:
+            results = (_compress_file(image_file, options) for image_file in iter_jobs())
+
+        finished = False
+        try:
+            for stats in results:
+                original = pending.pop(stats['filename'], None)
+                data = stats.pop('data', None)
+                self.compress_stats.append(stats)
+                self._notify('compress', stats['filename'])
+                if self.metrics:
+                    self.metrics.add('compress', stats)
+                if _report_compress(stats):
+                    compressed_count += 1
+                    if writer:
+                        writer.add(stats['output_name'].replace(os.sep, '/'), data)
+                    if original is not None and stats['output_name'] != original.name:
+                        # 与原地处理目录一样，格式转换（例如PNG转JPEG）后保留原文件
+                        writer.add(original.name, original.data, original.mtime_ns)
+                elif original is not None:
+                    writer.add(original.name, original.data, original.mtime_ns)
+            # 取消时不替换源压缩包
+            finished = not (cancelled and in_place)
+        finally:
+            if writer:
+                writer.close(commit=finished)
+
+        _report_format_savings(self.compress_stats)
+        return compressed_count
+
+    def create_renditions(self, renditions, output_dir=None, template=DEFAULT_RENDITION_TEMPLATE, quality=85,
+                          workers=1, resize_mode='balanced', resume=False, background=DEFAULT_BACKGROUND):
+        """
+        为每张图片生成多个尺寸和格式的版本
+
+        每张源图片只解码一次：先按最大的尺寸缩放（JPEG可直接以缩小后的尺寸解码），
+        再从大到小逐级缩放得到其余尺寸，每个尺寸依次编码为所需的各种格式。
+
+        Args:
+            renditions: 尺寸列表，每项为 dict(name, width, height, formats, quality)，
+                可用 parse_rendition 从 "thumb:320x320:jpeg,webp" 形式的字符串得到
+            output_dir: 输出目录，如果为None则输出到图片所在目录
+            template: 输出文件名模板，参见 DEFAULT_RENDITION_TEMPLATE
+            quality: 默认压缩质量，尺寸中指定了 quality 时以其为准
+            workers: 并行进程数，1为串行处理，0或None表示使用全部CPU核心
+            resize_mode: 缩放模式 ('quality', 'balanced', 'fast')，参见 RESIZE_MODES
+            resume: 是否从上次中断的位置继续，跳过断点恢复日志中已完成的文件
+            background: 带透明度的图片输出为JPEG时透明部分使用的背景色 (R, G, B)
+
+        Returns:
+            int: 成功处理的源图片数，每个文件的统计信息保存在 self.rendition_stats 中
+        """
+        if resize_mode not in RESIZE_MODES:
+            raise ValueError(f"不支持的缩放模式: {resize_mode}")
+        if not renditions:
+            raise ValueError("未指定任何输出尺寸")
+        for rendition in renditions:
+            for output_format in rendition['formats']:
+                if output_format not in RENDITION_FORMATS:
+                    raise ValueError(f"不支持的输出格式: {output_format}")
+                if output_format == 'avif' and not avif_available():
+                    raise ValueError("当前Pillow不支持AVIF编码")
+
+        processed_count = 0
+        self.rendition_stats = []
+
+        if output_dir and is_archive_path(output_dir):
+            raise ValueError("多尺寸版本不支持输出到压缩包")
+        if self.archive and not output_dir:
+            raise ValueError("来源为压缩包时需要指定输出目录")
+
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        for filename in image_files:
+        options = {
+            # 从大到小排列，后面的尺寸由前一个尺寸缩放得到
+            'renditions': sorted(renditions, key=lambda r: r['width'] * r['height'], reverse=True),
+            'output_dir': output_dir,
+            'template': template,
+            'quality': quality,
+            'resize_mode': resize_mode,
+            'metrics': self.metrics is not None,
+            'background': tuple(background),
+        }
+        settings = {key: options[key] for key in ('renditions', 'template', 'quality', 'resize_mode', 'background')}
+        journal = Journal(output_dir or self.directory, 'renditions', settings, resume=resume)
+        cancelled = False
+
+        def iter_jobs():
+            nonlocal cancelled
+            for image_file in self.iter_image_files(exclude_dirs=[output_dir] if output_dir else ()):
+                if self._cancelled():
+                    cancelled = True
+                    return
+                if journal.is_done(image_file.name):
+                    self._notify('renditions', image_file.name)
+                    continue
+                yield self._load(image_file)
+
+        if not workers:
+            workers = os.cpu_count() or 1
+        if workers > 1:
+            largest = options['renditions'][0]
+            results = _run_in_pool(_render_file, iter_jobs(), options, workers, self.memory_limit,
+                                   lambda image_file: _estimate_memory(image_file, largest['width'], largest['height'],
+                                                                       RESIZE_MODES[resize_mode]),
+                                   self.pool)
+        else:
+            results = (_render_file(image_file, options) for image_file in iter_jobs())
+
+        finished = False
+        try:
+            for stats in results:
+                self.rendition_stats.append(stats)
+                self._notify('renditions', stats['filename'])
+                if self.metrics:
+                    self.metrics.add('renditions', stats)
+                if _report_renditions(stats):
+                    processed_count += 1
+                    journal.mark(stats['filename'])
+            finished = not cancelled
+        finally:
+            journal.close(finished)
+
+        return processed_count
+
+
+def parse_rendition(spec):
+    """
+    解析尺寸描述字符串
+
+    格式为 "名称:宽x高[:格式1,格式2][:质量]"，例如 "thumb:320x320:jpeg,webp" 或
+    "full:1920x1080:jpeg:90"，未指定格式时输出JPEG。
+
+    Returns:
+        dict: 包含 name, width, height, formats 以及可选的 quality
+    """
+    parts = spec.split(':')
+    if len(parts) < 2 or len(parts) > 4:
+        raise ValueError(f"无效的尺寸描述: {spec}")
+    try:
+        width, height = (int(value) for value in parts[1].lower().split('x'))
+    except ValueError:
+        raise ValueError(f"无效的尺寸: {parts[1]}")
+    rendition = {
+        'name': parts[0],
+        'width': width,
+        'height': height,
+        'formats': parts[2].lower().split(',') if len(parts) > 2 and parts[2] else ['jpeg'],
+    }
+    if len(parts) > 3:
+        rendition['quality'] = int(parts[3])
+    return rendition
+
+
+def load_renditions(path):
+    """
+    从JSON配置文件读取尺寸列表
+
+    文件内容为列表，每项可以是尺寸描述字符串，也可以是包含 name, width, height,
+    formats, quality 的对象。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+
+    renditions = []
+    for item in items:
+        if isinstance(item, str):
+            renditions.append(parse_rendition(item))
+        else:
+            rendition = dict(item)
+            rendition.setdefault('formats', ['jpeg'])
+            renditions.append(rendition)
+    return renditions
+
+
+# EXIF中日期相关的标签
+_EXIF_IFD_POINTER = 0x8769
+_TAG_DATETIME = 0x0132
+_TAG_DATETIME_ORIGINAL = 0x9003
+
+
+def _read_exif_date(path):
+    """
+    直接从JPEG/TIFF文件头读取EXIF拍摄日期
+
+    只按需读取标记段头、IFD目录项和日期字符串所在的少量字节，不解码图片。
+    优先返回 DateTimeOriginal，其次返回 DateTime。
+
+    Returns:
+        str: EXIF中的原始日期字符串（如 "2023:12:01 12:30:45"），没有日期信息时返回None
+
+    Raises:
+        ValueError: 不是JPEG/TIFF文件或文件头无法解析，调用方应改用Pillow读取
+    """
+    with _open_binary(path) as f:
+        head = f.read(4)
+        if head[:2] == b'\xff\xd8':
+            base = _find_jpeg_exif(f)
+            if base is None:
+                return None
+        elif head in (b'II*\x00', b'MM\x00*'):
+            base = 0
+        else:
+            raise ValueError("不支持的文件格式")
+
+        f.seek(base)
+        byte_order = f.read(2)
+        if byte_order == b'II':
+            endian = '<'
+        elif byte_order == b'MM':
+            endian = '>'
+        else:
+            raise ValueError("无效的TIFF头")
+        magic, ifd_offset = struct.unpack(endian + 'HI', f.read(6))
+        if magic != 42:
+            raise ValueError("无效的TIFF头")
+
+        ifd0 = _read_ifd(f, base, endian, ifd_offset)
+        if _EXIF_IFD_POINTER in ifd0:
+            exif_ifd = _read_ifd(f, base, endian, ifd0[_EXIF_IFD_POINTER])
+            if _TAG_DATETIME_ORIGINAL in exif_ifd:
+                return exif_ifd[_TAG_DATETIME_ORIGINAL]
+        return ifd0.get(_TAG_DATETIME)
+
+
+def _find_jpeg_exif(f):
+    """逐个跳过JPEG标记段，返回EXIF中TIFF数据的起始偏移，没有EXIF时返回None"""
+    f.seek(2)
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            raise ValueError("无效的JPEG标记")
+        marker = header[1]
+        if marker in (0xDA, 0xD9):
+            # 已到图像数据，没有EXIF段
+            return None
+        length = struct.unpack('>H', header[2:])[0]
+        if marker == 0xE1 and f.read(6) == b'Exif\x00\x00':
+            return f.tell()
+        if marker == 0xE1:
+            f.seek(length - 8, 1)
+        else:
+            f.seek(length - 2, 1)
+
+
+def _read_ifd(f, base, endian, offset):
+    """读取一个IFD中与日期相关的目录项，返回 {标签: 值}"""
+    f.seek(base + offset)
+    count = struct.unpack(endian + 'H', f.read(2))[0]
+    data = f.read(count * 12)
+    if len(data) < count * 12:
+        raise ValueError("IFD数据不完整")
+
+    values = {}
+    for i in range(count):
+        tag, value_type, value_count, value = struct.unpack_from(endian + 'HHI4s', data, i * 12)
+        if tag == _EXIF_IFD_POINTER:
+            values[tag] = struct.unpack(endian + 'I', value)[0]
+        elif tag in (_TAG_DATETIME, _TAG_DATETIME_ORIGINAL) and value_type == 2:
+            # ASCII类型，超过4字节时值存放在偏移处
+            if value_count > 4:
+                f.seek(base + struct.unpack(endian + 'I', value)[0])
+                value = f.read(value_count)
+            values[tag] = value[:value_count].split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+    return values
+
+
+def _open_binary(source):
+    """打开文件路径，或把压缩包成员的内容（bytes）包装为文件对象"""
+    return io.BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')
+
+
+def _image_source(image_file):
+    """传给 Image.open 的来源：压缩包成员使用内存中的内容，否则使用文件路径"""
+    return io.BytesIO(image_file.data) if image_file.data is not None else image_file.path
+
+
+def _read_exif_date_pillow(path):
+    """使用Pillow读取EXIF拍摄日期，用于其他格式或文件头无法直接解析的情况"""
+    with _open_binary(path) as f, Image.open(f) as image:
+        exifdata = image.getexif()
+
+    date_str = exifdata.get_ifd(_EXIF_IFD_POINTER).get(_TAG_DATETIME_ORIGINAL) or exifdata.get(_TAG_DATETIME)
+    return str(date_str) if date_str else None
+
+
+def _record_compress(manifest, stats, settings, output_dir):
+    """把压缩结果写入清单"""
+    output_name = stats['output_name']
+    state = dict(stats['source_state'], output=output_name)
+    manifest.record('compress', stats['filename'], state, settings)
+    if not output_dir and 'output_state' in stats:
+        # 原地处理时格式转换产生的新文件（例如PNG转JPEG）同样记录下来，避免下次被重复压缩
+        manifest.record('compress', output_name, dict(stats['output_state'], output=output_name), settings)
+
+
+def _link_duplicate(stats, duplicate, output_dir):
+    """把重复图片在输出目录中的位置硬链接到原图的输出文件"""
+    extension = os.path.splitext(stats['output_name'])[1]
+    link_path = os.path.join(output_dir, os.path.splitext(duplicate)[0] + extension)
+    if os.path.abspath(link_path) == os.path.abspath(stats['new_path']):
+        # 例如 a.png 与 a.jpg 重复，二者的输出是同一个文件
+        return
+    try:
+        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.link(stats['new_path'], link_path)
+        logger.info("链接: %s -> %s", duplicate, stats['output_name'])
+    except OSError as e:
+        logger.error("链接 %s 时出错: %s", duplicate, e)
+
+
+def _hamming(a, b):
+    """两个哈希值之间的汉明距离"""
+    return bin(a ^ b).count('1')
+
+
+def _dhash(img):
+    """
+    计算差值哈希（dHash）
+
+    把图片缩小为 (DHASH_SIZE + 1) x DHASH_SIZE 的灰度图，比较每行相邻像素的亮度，
+    得到 DHASH_SIZE * DHASH_SIZE 位的整数。重新压缩、缩放或轻微调色不会改变大部分位。
+    """
+    # JPEG 直接以缩小后的尺寸解码灰度数据，不必解码整张图片；大图按条带解码并缩小
+    img.draft('L', (DHASH_SIZE * 8, DHASH_SIZE * 8))
+    if img.width * img.height > LARGE_IMAGE_PIXELS:
+        img = _reduce_in_strips(img, _fit_size(img.size, DHASH_SIZE * 8, DHASH_SIZE * 8), 2.0, _StageTimer()) or img
+    small = img.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(DHASH_SIZE):
+        offset = row * (DHASH_SIZE + 1)
+        for col in range(DHASH_SIZE):
+            value = value << 1 | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _hash_file(image_file, options):
+    """计算单个文件的感知哈希，定义在模块级别以便在进程池中执行"""
+    stats = {'filename': image_file.name, 'size': image_file.size, 'mtime_ns': image_file.mtime_ns, 'error': None}
+    try:
+        with Image.open(_image_source(image_file)) as img:
+            stats['dhash'] = _dhash(img)
+    except MemoryError:
+        stats['error'] = "内存不足"
+    except Exception as e:
+        stats['error'] = str(e)
+    return stats
+
+
+class WorkerPool:
+    """
+    并行处理使用的进程池，工作进程异常退出后可以重建
+
+    工作进程被系统终止或直接退出后，ProcessPoolExecutor 不能再提交任务。restart() 用新的
+    进程池替换它，共享同一个 WorkerPool 的后续处理（例如命令行依次处理的其他目录）不受影响。
+    """
+
+    def __init__(self, workers, memory_limit=None, mp_context=None):
+        """
+        Args:
+            workers: 工作进程数
+            memory_limit: 与 ImageProcessor 的 memory_limit 相同，参见 _run_in_pool
+            mp_context: 创建工作进程使用的 multiprocessing 上下文，None 为平台默认
+        """
+        self.workers = workers
+        self.memory_limit = memory_limit
+        self.mp_context = mp_context
+        self.restarts = 0
+        self.executor = self._create()
+
+    def _create(self):
+        from concurrent.futures import ProcessPoolExecutor
+        initializer, initargs = None, ()
+        if self.memory_limit:
+            initializer, initargs = _limit_worker_memory, (self.memory_limit + WORKER_MEMORY_OVERHEAD,)
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context,
+                                   initializer=initializer, initargs=initargs)
+
+    @property
+    def broken(self):
+        """是否有工作进程异常退出，进程池已不能使用"""
+        return bool(getattr(self.executor, '_broken', False))
+
+    def restart(self, executor=None):
+        """
+        重建进程池
+
+        Args:
+            executor: 发现损坏的进程池，已经被替换过时不再重复重建
+        """
+        if executor is not None and executor is not self.executor:
+            return
+        self.executor.shutdown(wait=False)
+        self.executor = self._create()
+        self.restarts += 1
+        logger.warning("工作进程异常退出，已重新启动进程池")
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+def _run_in_pool(func, jobs, options, workers, memory_limit=None, cost=None, pool=None):
+    """
+    在进程池中执行单文件任务，按完成顺序逐个返回结果
+
+    同时在途的任务数被限制为进程数的若干倍，避免一次性提交全部文件占用过多内存。
+    指定 memory_limit 时还按 cost(image_file) 估算的内存提交任务：在途任务的估算总量
+    不超过 memory_limit（单个任务超过上限时等其他任务完成后单独执行），并把每个工作进程
+    的内存限制为 memory_limit 加上 WORKER_MEMORY_OVERHEAD，估算偏小的图片以内存不足的
+    错误结束，而不是导致整个进程被系统终止。
+    子进程异常会被转换为该文件的错误结果，不影响其他文件。工作进程异常退出时，当时在途的
+    文件都作为失败返回，随后重建进程池继续处理其余文件。
+    指定 pool（WorkerPool）时使用该进程池，否则为本次处理创建新的进程池。
+    """
+    if pool is None:
+        with WorkerPool(workers, memory_limit) as pool:
+            yield from _run_in_pool(func, jobs, options, workers, memory_limit, cost, pool)
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, wait
+    from concurrent.futures.process import BrokenProcessPool
+    max_pending = workers * 4
+    pending = {}
+    jobs = iter(jobs)
+    # 因内存不足暂未提交的任务及其估算内存
+    waiting = None
+    in_use = 0
+    while True:
+        while len(pending) < max_pending:
+            if waiting is None:
+                try:
+                    image_file = next(jobs)
+                except StopIteration:
+                    break
+                waiting = (image_file, cost(image_file) if memory_limit else 0)
+            image_file, job_cost = waiting
+            if memory_limit and pending and in_use + job_cost > memory_limit:
+                break
+            executor = pool.executor
             try:
-                old_path = os.path.join(self.directory, filename)
-                file_extension = os.path.splitext(filename)[1].lower()
-                
-                # 获取原始文件大小
-                old_size = os.path.getsize(old_path)
-                
-                # 确定输出路径
-                if output_dir:
-                    new_path = os.path.join(output_dir, filename)
-                else:
-                    new_path = old_path
-
-                # 打开并处理图片
-                with Image.open(old_path) as img:
-                    # 获取原始尺寸
-                    original_width, original_height = img.size
-                    
-                    # 计算新尺寸以保持宽高比
-                    if original_width > max_width or original_height > max_height:
-                        # 如果图片尺寸超过指定的最大尺寸，则进行缩放
-                        img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-                    
-                    # 对于所有JPEG文件，强制重新压缩以确保文件大小减小
-                    if file_extension in ['.jpg', '.jpeg']:
-                        # 转换模式确保兼容性
-                        if img.mode in ('RGBA', 'LA', 'P'):
-                            # 如果有透明度，转换为RGB（会丢失透明度信息）
-                            img = img.convert('RGB')
-                        
-                        # 保存压缩后的图片
-                        img.save(new_path, 'JPEG', quality=quality, optimize=True)
-                        
-                    elif file_extension == '.png':
-                        # PNG格式处理 - 转换为JPEG以实现更好的压缩效果
-                        # 保存为PNG格式并尝试优化
-                        if img.mode == 'P':
-                            img = img.convert('RGBA')
-                        
+                future = executor.submit(func, image_file, options)
+            except BrokenProcessPool:
+                # 进程池在上次提交后损坏，在途的任务会各自以错误结束，这里先处理完它们再重建
+                if pending:
+                    break
+                pool.restart(executor)
+                continue
+            waiting = None
+            in_use += job_cost
+            pending[future] = (image_file.name, job_cost, executor)
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            filename, job_cost, executor = pending.pop(future)
+            in_use -= job_cost
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                yield {'filename': filename, 'error': "工作进程异常退出"}
+                pool.restart(executor)
+            except Exception as e:
+                yield {'filename': filename, 'error': str(e)}
+
+
+def _limit_worker_memory(limit):
+    """工作进程的初始化函数：限制进程可分配的内存（Windows 不支持，不做限制）"""
+    if resource is not None:
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def _estimate_memory(image_file, max_width, max_height, reducing_gap):
+    """
+    估算处理单张图片所需的内存（字节），只读取文件头
+
+    按解码后的数据估算：JPEG 按 draft() 缩小后的尺寸，可以按条带解码的大图按一个条带加上
+    缩小后的图片，其他图片按整张图片（带透明度时缩放前还要转换为预乘透明度的副本）。
+    另外加上输出尺寸的若干份副本（缩放、模式转换和编码）。无法识别的文件返回0。
+    """
+    try:
+        with Image.open(_image_source(image_file)) as img:
+            width, height = img.size
+            final_width, final_height = _fit_size(img.size, max_width, max_height)
+            pixel_bytes = 1 if img.mode in ('1', 'L', 'P') else 4
+            if img.mode in ('RGBA', 'LA'):
+                pixel_bytes *= 2
+            if width * height > LARGE_IMAGE_PIXELS and _strip_iterator(img) is not None:
+                factor_x, factor_y = _reduce_factors(img.size, (final_width, final_height),
+                                                     reducing_gap or LARGE_IMAGE_REDUCING_GAP)
+                decoded = STRIP_BYTES * 3 + -(-width // factor_x) * -(-height // factor_y) * pixel_bytes
+            else:
+                scale = 1
+                if img.format == 'JPEG' and reducing_gap is not None:
+                    # 与 JpegImageFile.draft 选择缩放比例的方式相同
+                    ratio = min(width // max(int(max_width * reducing_gap), 1),
+                                height // max(int(max_height * reducing_gap), 1))
+                    scale = next((s for s in (8, 4, 2) if ratio >= s), 1)
+                decoded = -(-width // scale) * -(-height // scale) * pixel_bytes
+    except Exception:
+        return 0
+    return decoded + final_width * final_height * 4 * 3
+
+
+def _report_compress(stats):
+    """输出单个文件的压缩结果，成功返回True"""
+    filename = stats['filename']
+    if stats.get('error'):
+        logger.error("压缩 %s 时出错: %s", filename, stats['error'])
+        return False
+    if not logger.isEnabledFor(logging.INFO):
+        return True
+
+    old_size = stats['old_size']
+    new_size = stats['new_size']
+    ratio = (old_size - new_size) / old_size * 100 if old_size > 0 else 0
+
+    # 显示压缩结果
+    detail = f"{old_size} -> {new_size} 字节, 减少 {ratio:.1f}%"
+    if 'format' in stats:
+        detail += f", 格式 {stats['format']}"
+    if 'quality' in stats:
+        detail += f", 质量 {stats['quality']}"
+        if not stats['target_met']:
+            detail += ", 未达到目标大小"
+    if stats['old_path'] != stats['new_path']:
+        logger.info("转换: %s -> %s (%s)", filename, stats['output_name'], detail)
+    else:
+        logger.info("压缩: %s (%s)", filename, detail)
+    return True
+
+
+def _encode_jpeg(img, quality, options, stats):
+    """编码JPEG图片，指定了目标大小时返回二分查找选中的编码结果"""
+    target_size = options.get('target_size')
+    if not target_size:
+        return _encode_image(img, 'JPEG', quality=quality, optimize=True)
+
+    data, chosen_quality = _encode_jpeg_to_target(img, target_size, quality)
+    stats['quality'] = chosen_quality
+    stats['target_met'] = len(data) <= target_size
+    return data
+
+
+def _report_format_savings(compress_stats):
+    """指定输出格式时，输出与不指定输出格式相比节省的总字节数"""
+    compared = [stats for stats in compress_stats if not stats.get('error') and 'baseline_size' in stats]
+    if not compared:
+        return
+    baseline = sum(stats['baseline_size'] for stats in compared)
+    saved = baseline - sum(stats['new_size'] for stats in compared)
+    formats = {}
+    for stats in compared:
+        formats[stats['format']] = formats.get(stats['format'], 0) + 1
+    logger.info("输出格式: %s; 与默认输出相比节省 %d 字节 (%.1f%%)",
+                ", ".join(f"{name} {count} 张" for name, count in sorted(formats.items())),
+                saved, saved / baseline * 100 if baseline else 0)
+
+
+def avif_available():
+    """当前Pillow是否支持AVIF编码（Pillow 11.2 起内置，且需要编译时带有libavif）"""
+    from PIL import features
+    return 'avif' in features.modules and features.check_module('avif')
+
+
+def _analyze_image(img):
+    """
+    快速分析图片内容，供自动选择输出格式
+
+    Returns:
+        tuple: (是否实际用到透明度, 颜色数)，颜色超过256种时颜色数为None
+    """
+    if img.mode in ('RGBA', 'LA'):
+        has_alpha = img.getchannel('A').getextrema()[0] < 255
+    else:
+        has_alpha = 'transparency' in img.info
+    # 颜色超过256种时 getcolors 立即返回None，不会统计全部颜色
+    colors = img.getcolors(256)
+    return has_alpha, None if colors is None else len(colors)
+
+
+def _palette_image(img, color_count):
+    """把颜色不超过256种的RGB/RGBA图片转换为调色板模式，结果与原图不完全一致时返回原图"""
+    if img.mode not in ('RGB', 'RGBA'):
+        return img
+    palette = img.quantize(color_count)
+    if palette.convert(img.mode).tobytes() != img.tobytes():
+        return img
+    return palette
+
+
+def _format_candidates(img, quality, background):
+    """
+    按图片内容列出自动选择格式时的候选编码 [(格式名, 图片, 编码参数)]
+
+    质量低于100时考虑相同质量的有损编码：实际用到透明度的图片使用WebP、量化为256色的PNG
+    和AVIF，保留透明度；不透明的图片使用JPEG、WebP和AVIF。颜色不超过256种的图片（图标、
+    截图、图表等，也包括灰度照片）和质量为100时还考虑无损编码：调色板PNG和无损WebP。
+    """
+    if img.mode in ('PA', 'RGBa', 'La'):
+        img = img.convert('RGBA')
+    elif img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        img = img.convert('RGB')
+    has_alpha, color_count = _analyze_image(img)
+    if not has_alpha:
+        # 完全不透明的透明度通道只会增大文件
+        img = _flatten_alpha(img, background)
+
+    candidates = []
+    if color_count is not None or quality >= 100:
+        png = _palette_image(img, color_count) if color_count else img
+        candidates += [('png', png, {'optimize': True}), ('webp', img, {'lossless': True})]
+    if quality >= 100:
+        return candidates
+
+    if has_alpha:
+        if color_count is None:
+            candidates.append(('png', img.convert('RGBA').quantize(256), {'optimize': True}))
+        candidates.append(('webp', img, {'quality': quality}))
+    else:
+        candidates += [('jpeg', img, {'quality': quality, 'optimize': True}),
+                       ('webp', img, {'quality': quality})]
+    if avif_available():
+        candidates.append(('avif', img, {'quality': quality, 'speed': AVIF_SPEED}))
+    return candidates
+
+
+def _encode_auto(img, quality, options):
+    """
+    在内存中试编码各候选格式，选用最小的结果
+
+    Returns:
+        tuple: (编码后的数据, 格式名, 各候选格式的编码大小)
+    """
+    best = None
+    sizes = {}
+    for name, candidate, params in _format_candidates(img, quality,
+                                                       options.get('background', DEFAULT_BACKGROUND)):
+        data = _encode_image(candidate, RENDITION_FORMATS[name][0], **params)
+        sizes[name] = len(data)
+        if best is None or len(data) < len(best[0]):
+            best = (data, name)
+    return best[0], best[1], sizes
+
+
+def _encode_format(img, output_format, quality, options, stats):
+    """
+    按指定格式编码：JPEG与不指定输出格式时相同（支持目标文件大小），PNG为无损编码
+    （颜色不超过256种时使用调色板），WebP在质量为100时为无损编码，WebP和AVIF保留透明度
+    """
+    if output_format == 'jpeg':
+        img = _flatten_alpha(img, options.get('background', DEFAULT_BACKGROUND))
+        return _encode_jpeg(img, quality, options, stats)
+    if img.mode in ('PA', 'RGBa', 'La', 'CMYK', 'YCbCr', 'LAB', 'HSV'):
+        img = img.convert('RGBA' if img.mode.endswith(('A', 'a')) else 'RGB')
+    if output_format == 'png':
+        color_count = _analyze_image(img)[1]
+        return _encode_image(_palette_image(img, color_count) if color_count else img, 'PNG', optimize=True)
+    if output_format == 'webp':
+        if quality >= 100:
+            return _encode_image(img, 'WEBP', lossless=True)
+        return _encode_image(img, 'WEBP', quality=quality)
+    return _encode_image(img, 'AVIF', quality=quality, speed=AVIF_SPEED)
+
+
+def _encode_image(img, pil_format, **params):
+    """把图片编码到内存中"""
+    buffer = io.BytesIO()
+    img.save(buffer, pil_format, **params)
+    return buffer.getvalue()
+
+
+def _write_file(path, data):
+    """
+    原子地写入文件
+
+    先写入同一目录下的临时文件并 fsync，再用 os.replace 替换目标文件。进程在任何时刻
+    被终止，目标文件要么保持原样，要么是完整的新内容，不会留下被截断的原图。
+    """
+    import shutil
+    directory = os.path.dirname(path) or '.'
+    temp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.urandom(16).hex()}.tmp")
+    # 使用 0o666 创建，使权限与直接写入时一样受 umask 控制
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            # 覆盖原文件时保留其权限
+            shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    _fsync_directory(directory)
+
+
+def _fsync_directory(directory):
+    """同步目录项，使替换操作本身也持久化（不支持的平台上忽略）"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    try:
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _flatten_alpha(img, background=DEFAULT_BACKGROUND):
+    """
+    转换为可以保存为JPEG的模式，透明部分铺上 background 颜色
+
+    RGB、L 等不含透明度的模式原样返回，不做任何复制。带透明度的图片只合成一次：
+    以图片自身作为蒙版粘贴到背景上，Pillow 直接读取其中的 alpha 通道，
+    不会像 split() 那样为每个通道各分配一份整图大小的副本。
+    """
+    if img.mode == 'P':
+        if 'transparency' not in img.info:
+            return img.convert('RGB')
+        img = img.convert('RGBA')
+    elif img.mode in ('PA', 'RGBa', 'La'):
+        img = img.convert('RGBA')
+    elif img.mode not in ('RGBA', 'LA'):
+        return img
+    flattened = Image.new('RGB', img.size, background)
+    flattened.paste(img, mask=img)
+    return flattened
+
+
+def _resize_to_fit(img, max_width, max_height, reducing_gap, timer):
+    """
+    解码并缩放图片到不超过最大宽高的尺寸
+
+    与 Image.thumbnail 的处理相同：加载图片数据之前先调用 draft()，JPEG 可以直接以
+    缩小后的尺寸解码，然后再精确缩放。像素数超过 LARGE_IMAGE_PIXELS 的图片尽可能按条带
+    解码，参见 _reduce_in_strips。解码和缩放分别计入 decode 和 resize 阶段。
+    """
+    final_size = _fit_size(img.size, max_width, max_height)
+    if final_size != img.size and img.width * img.height > LARGE_IMAGE_PIXELS:
+        reduced = _reduce_in_strips(img, final_size, reducing_gap or LARGE_IMAGE_REDUCING_GAP, timer)
+        if reduced is not None:
+            return reduced
+    box = None
+    with timer.stage('decode'):
+        if final_size != img.size and reducing_gap is not None:
+            result = img.draft(None, (int(max_width * reducing_gap), int(max_height * reducing_gap)))
+            if result is not None:
+                box = result[1]
+        img.load()
+    if img.size != final_size:
+        with timer.stage('resize'):
+            img = img.resize(final_size, Image.Resampling.LANCZOS, box=box, reducing_gap=reducing_gap)
+    return img
+
+
+def _reduce_factors(size, final_size, reducing_gap):
+    """与 Image.resize 相同的整数缩小倍数 (横向, 纵向)"""
+    return (int(size[0] / final_size[0] / reducing_gap) or 1,
+            int(size[1] / final_size[1] / reducing_gap) or 1)
+
+
+def _reduce_in_strips(img, final_size, reducing_gap, timer):
+    """
+    大图模式：按水平条带解码，每个条带立即按整数倍缩小，再把缩小后的图片精确缩放到 final_size
+
+    内存中只保留一个条带（不超过 STRIP_BYTES）和缩小后的图片。条带高度是纵向缩小倍数的
+    整数倍，不带透明度的图片结果与 Image.resize(final_size, LANCZOS, reducing_gap=reducing_gap)
+    完全一致；Image.resize 对带透明度的图片不使用 reducing_gap，这里同样先整数倍缩小。
+    图片格式不支持按条带解码或缩小倍数为1时返回None，由调用方整张解码。
+    """
+    strips = _strip_iterator(img)
+    factor_x, factor_y = _reduce_factors(img.size, final_size, reducing_gap)
+    if strips is None or (factor_x == 1 and factor_y == 1):
+        return None
+
+    # 与 Image.resize 相同，带透明度的图片在预乘透明度后缩放
+    premultiplied = {'RGBA': 'RGBa', 'LA': 'La'}.get(img.mode)
+    width, height = img.size
+    rows = max(STRIP_BYTES // (width * 4) // factor_y, 1) * factor_y
+    reduced = Image.new(premultiplied or img.mode, (-(-width // factor_x), -(-height // factor_y)))
+    with timer.stage('decode'):
+        y = 0
+        for strip, box in strips(rows):
+            if premultiplied:
+                strip = strip.convert(premultiplied)
+            reduced.paste(strip.reduce((factor_x, factor_y), box=box), (0, y // factor_y))
+            y += box[3] - box[1]
+    with timer.stage('resize'):
+        img_box = (0, 0, width / factor_x, height / factor_y)
+        result = reduced.resize(final_size, Image.Resampling.LANCZOS, box=img_box)
+        if premultiplied:
+            result = result.convert(img.mode)
+    result.info = img.info.copy()
+    return result
+
+
+def _strip_iterator(img):
+    """
+    返回按条带解码图片的函数 strips(rows)，依次产生 (条带图片, 条带中图片数据所在的区域)，
+    每个条带最多 rows 行。只支持 STRIP_MODES 中的8位非隔行PNG和未压缩数据（TIFF、BMP等），
+    其他格式返回None。
+    """
+    if img.mode not in STRIP_MODES or not img.tile or img.fp is None:
+        return None
+    codecs = {tile[0] for tile in img.tile}
+    if codecs == {'zip'} and img.format == 'PNG' and len(img.tile) == 1 and img.tile[0][3] == img.mode \
+            and not img.info.get('interlace'):
+        return lambda rows: _iter_png_strips(img, rows)
+    if codecs == {'raw'}:
+        for _, extents, _, args in img.tile:
+            rawmode = args[0] if isinstance(args, tuple) else args
+            if extents[0] != 0 or extents[2] != img.width or rawmode not in STRIP_RAW_PIXEL_BYTES:
+                return None
+        return lambda rows: _iter_raw_strips(img, rows)
+    return None
+
+
+def _iter_raw_strips(img, rows):
+    """按条带读取未压缩的图片数据，每个数据块（tile）为整行，可能自下而上存放"""
+    tiles = []
+    for _, extents, offset, args in img.tile:
+        if not isinstance(args, tuple):
+            args = (args,)
+        rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+        tiles.append((extents[1], extents[3], offset, rawmode,
+                      stride or img.width * STRIP_RAW_PIXEL_BYTES[rawmode], orientation or 1))
+    for y0 in range(0, img.height, rows):
+        y1 = min(y0 + rows, img.height)
+        strip = Image.new(img.mode, (img.width, y1 - y0))
+        for top, bottom, offset, rawmode, stride, orientation in tiles:
+            r0, r1 = max(y0, top), min(y1, bottom)
+            if r0 >= r1:
+                continue
+            if orientation > 0:
+                img.fp.seek(offset + (r0 - top) * stride)
+            else:
+                img.fp.seek(offset + (bottom - r1) * stride)
+            decoder = Image._getdecoder(img.mode, 'raw', (rawmode, stride, orientation))
+            decoder.setimage(strip.im, (0, r0 - y0, img.width, r1 - y0))
+            decoder.decode(img.fp.read((r1 - r0) * stride))
+            decoder.cleanup()
+        yield strip, (0, 0, img.width, y1 - y0)
+
+
+def _iter_png_strips(img, rows):
+    """
+    按条带解码PNG
+
+    用 zlib 流式解压IDAT数据，每次取出一个条带的各行（仍带有行过滤）。行过滤可能引用上一行，
+    因此在条带前加上一行未过滤的上一行像素，再交给 Pillow 的PNG解码器解码，产生的条带
+    第一行不属于本条带。
+    """
+    width, height = img.size
+    row_bytes = width * len(img.mode) + 1
+    idat = _iter_png_idat(img.fp)
+    inflater = zlib.decompressobj()
+    tail = b''
+    previous = None
+    for y0 in range(0, height, rows):
+        count = min(rows, height - y0)
+        filtered = bytearray() if previous is None else bytearray(b'\x00' + previous)
+        needed = len(filtered) + count * row_bytes
+        while len(filtered) < needed:
+            if not tail:
+                tail = next(idat, b'')
+            data = inflater.decompress(tail, needed - len(filtered))
+            if not tail and not data:
+                raise ValueError("PNG图像数据不完整")
+            filtered += data
+            tail = inflater.unconsumed_tail
+        top = 0 if previous is None else 1
+        strip = Image.new(img.mode, (width, count + top))
+        decoder = Image._getdecoder(img.mode, 'zip', img.mode)
+        decoder.setimage(strip.im, (0, 0) + strip.size)
+        consumed, error = decoder.decode(zlib.compress(bytes(filtered), 0))
+        decoder.cleanup()
+        if consumed >= 0 or error < 0:
+            raise ValueError("PNG图像数据解码失败")
+        previous = strip.crop((0, strip.height - 1, width, strip.height)).tobytes()
+        yield strip, (0, top, width, strip.height)
+
+
+def _iter_png_idat(f):
+    """逐块读取PNG文件中IDAT数据块的内容"""
+    f.seek(8)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IDAT':
+            while length:
+                data = f.read(min(length, 1 << 20))
+                if not data:
+                    return
+                length -= len(data)
+                yield data
+        elif chunk_type == b'IEND':
+            return
+        else:
+            f.seek(length, 1)
+        # 跳过CRC
+        f.seek(4, 1)
+
+
+def _encode_jpeg_to_target(img, target_size, max_quality,
+                           min_quality=TARGET_SIZE_MIN_QUALITY, max_attempts=TARGET_SIZE_MAX_ATTEMPTS):
+    """
+    在内存中二分查找不超过目标大小的最高JPEG质量
+
+    先以 max_quality 编码，已满足目标时直接使用，不会过度压缩小图片；否则在
+    [min_quality, max_quality) 中二分查找，最多编码 max_attempts 次。所有尝试都复用
+    同一张已缩放的图片。仍无法满足目标时使用 min_quality 的结果。max_quality 低于
+    min_quality 时不会提高质量，直接使用 max_quality 的结果。
+
+    Returns:
+        tuple: (编码后的数据, 选用的质量)
+    """
+    def encode(q):
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=q, optimize=True)
+        return buffer.getvalue()
+
+    data = encode(max_quality)
+    attempts = 1
+    min_quality = min(min_quality, max_quality)
+    if len(data) <= target_size or min_quality == max_quality:
+        return data, max_quality
+
+    best = None
+    lowest = (max_quality, data)
+    low, high = min_quality, max_quality - 1
+    while low <= high and attempts < max_attempts:
+        mid = (low + high) // 2
+        data = encode(mid)
+        attempts += 1
+        if len(data) <= target_size:
+            best = (data, mid)
+            low = mid + 1
+        else:
+            lowest = (mid, data)
+            high = mid - 1
+
+    if best is not None:
+        return best
+    if lowest[0] == min_quality:
+        return lowest[1], min_quality
+    return encode(min_quality), min_quality
+
+
+def _compress_file(image_file, options):
+    """
+    压缩单个图片文件
+
+    该函数定义在模块级别，以便在进程池中执行。任何异常都会被捕获并记录在返回的统计信息中。
+
+    Args:
+        image_file: 扫描得到的 ImageFile
+        options: 压缩参数 (quality, max_width, max_height, output_dir, resize_mode, target_size,
+            background, output_format, archive_output, record_state, metrics)
+
+    Returns:
+        dict: 统计信息，包含 filename, old_path, new_path, output_name, old_size, new_size, seconds 和 error。
+            指定 target_size 时还包含选用的 quality 以及是否达到目标的 target_met。
+            指定 output_format 时还包含选用的格式 format，以及不指定输出格式时的输出大小 baseline_size。
+            archive_output 为真时不写入文件，编码后的内容放在 data 中。
+            record_state 为真时还包含处理后源文件（及原地转换产生的新文件）的状态，供增量清单使用。
+            metrics 为真时还包含各阶段耗时 stages
+    """
+    filename = image_file.name
+    old_path = image_file.path
+    stats = {'filename': filename, 'old_path': old_path, 'error': None}
+    timer = _StageTimer(stats.setdefault('stages', {}) if options.get('metrics') else None)
+    start = time.perf_counter()
+    try:
+        quality = options['quality']
+        max_width = options['max_width']
+        max_height = options['max_height']
+        output_dir = options['output_dir']
+        reducing_gap = RESIZE_MODES[options.get('resize_mode', 'balanced')]
+        file_extension = os.path.splitext(filename)[1].lower()
+        
+        # 原始文件大小取自扫描结果
+        old_size = image_file.size
+        new_filename = filename
+        
+        # 确定输出路径，输出目录中保持与图片目录相同的子目录结构
+        if options.get('archive_output'):
+            # 输出由主进程写入压缩包
+            new_path = filename
+        elif output_dir:
+            new_path = os.path.join(output_dir, filename)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        else:
+            new_path = old_path
+
+        # 打开并处理图片
+        with timer.stage('open'):
+            source = Image.open(_image_source(image_file))
+        with source:
+            # 如果图片尺寸超过指定的最大尺寸，则按原宽高比进行缩放
+            # 此时图片数据尚未加载，JPEG 可以直接以缩小后的尺寸解码
+            img = _resize_to_fit(source, max_width, max_height, reducing_gap, timer)
+
+            output_format = options.get('output_format')
+            if output_format:
+                with timer.stage('encode'):
+                    if output_format == 'auto':
+                        data, output_format, sizes = _encode_auto(img, quality, options)
+                    else:
+                        data = _encode_format(img, output_format, quality, options, stats)
+                        sizes = {output_format: len(data)}
+                with timer.stage('baseline'):
+                    # 不指定输出格式时的结果，与相同参数的JPEG候选完全一致时直接使用其大小
+                    if file_extension == '.png' and quality >= 100:
+                        baseline_size = len(_encode_image(img, 'PNG', optimize=True))
+                    elif 'jpeg' in sizes:
+                        baseline_size = sizes['jpeg']
+                    else:
+                        baseline_size = len(_encode_format(img, 'jpeg', quality, options, {}))
+                stats['format'] = output_format
+                stats['baseline_size'] = baseline_size
+                extension = RENDITION_FORMATS[output_format][1]
+                if file_extension not in (('.jpg', '.jpeg') if output_format == 'jpeg' else ('.' + extension,)):
+                    new_filename = os.path.splitext(filename)[0] + '.' + extension
+                    new_path = os.path.splitext(new_path)[0] + '.' + extension
+            else:
+                with timer.stage('convert'):
+                    output_format = 'JPEG'
+                    if file_extension == '.png':
                         # 如果用户希望获得更小的文件大小，将PNG转换为JPEG
                         if quality < 100:  # 只有在指定压缩质量时才转换格式
-                            # 处理透明背景 - 使用白色背景替换
-                            if img.mode == 'RGBA':
-                                # 创建白色背景
-                                background = Image.new('RGB', img.size, (255, 255, 255))
-                                # 粘贴图像并使用alpha通道作为掩码
-                                background.paste(img, mask=img.split()[-1])
-                                img = background
-                            
                             # 更改文件扩展名
-                            new_filename = filename.replace('.png', '.jpg')
-                            if output_dir:
-                                new_path = os.path.join(output_dir, new_filename)
-                            else:
-                                new_path = os.path.join(os.path.dirname(new_path), new_filename)
-                            
-                            img.save(new_path, 'JPEG', quality=quality, optimize=True)
+                            new_filename = os.path.splitext(filename)[0] + '.jpg'
+                            new_path = os.path.splitext(new_path)[0] + '.jpg'
                         else:
                             # 保持PNG格式但进行优化
-                            img.save(new_path, 'PNG', optimize=True)
+                            output_format = 'PNG'
+                    if output_format == 'JPEG':
+                        # JPEG和其他格式统一输出为JPEG，透明部分铺上背景色
+                        img = _flatten_alpha(img, options.get('background', DEFAULT_BACKGROUND))
+
+                with timer.stage('encode'):
+                    if output_format == 'JPEG':
+                        data = _encode_jpeg(img, quality, options, stats)
                     else:
-                        # 其他格式统一转换为JPEG以获得更好的压缩效果
-                        if img.mode in ('RGBA', 'LA', 'P'):
-                            img = img.convert('RGB')
-                        img.save(new_path, 'JPEG', quality=quality, optimize=True)
-                
-                # 获取新文件大小并计算压缩比
-                new_size = os.path.getsize(new_path)
-                ratio = (old_size - new_size) / old_size * 100 if old_size > 0 else 0
-                
-                # 显示压缩结果
-                if old_path != new_path:
-                    print(f"转换: {filename} -> {os.path.basename(new_path)} ({old_size} -> {new_size} 字节, 减少 {ratio:.1f}%)")
-                else:
-                    print(f"压缩: {filename} ({old_size} -> {new_size} 字节, 减少 {ratio:.1f}%)")
-                compressed_count += 1
-                    
-            except Exception as e:
-                print(f"压缩 {filename} 时出错: {e}")
+                        data = _encode_image(img, 'PNG', optimize=True)
+
+        if options.get('archive_output'):
+            stats['data'] = data
+        else:
+            with timer.stage('write'):
+                _write_file(new_path, data)
         
-        return compressed_count
+        stats['new_path'] = new_path
+        stats['output_name'] = new_filename
+        stats['old_size'] = old_size
+        stats['new_size'] = len(data)
+        if options.get('record_state'):
+            stats['source_state'] = _file_state(old_path)
+            if not output_dir and new_path != old_path:
+                stats['output_state'] = _file_state(new_path)
+    except MemoryError:
+        stats['error'] = "内存不足"
+    except Exception as e:
+        stats['error'] = str(e)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def _report_renditions(stats):
+    """输出单个文件的多尺寸处理结果，成功返回True"""
+    filename = stats['filename']
+    if stats.get('error'):
+        logger.error("处理 %s 时出错: %s", filename, stats['error'])
+        return False
+    if logger.isEnabledFor(logging.INFO):
+        outputs = ', '.join(f"{name} ({size} 字节)" for name, size in stats['outputs'])
+        logger.info("生成: %s -> %s", filename, outputs)
+    return True
+
+
+def _render_file(image_file, options):
+    """
+    为单个图片文件生成所有尺寸和格式
+
+    该函数定义在模块级别，以便在进程池中执行。任何异常都会被捕获并记录在返回的统计信息中。
+
+    Args:
+        image_file: 扫描得到的 ImageFile
+        options: 参数 (renditions, output_dir, template, quality, resize_mode, background, metrics)，
+            renditions 已按从大到小排列
+
+    Returns:
+        dict: 统计信息，包含 filename, old_size, new_size（输出总字节数）, outputs（输出文件名和大小的列表）,
+            seconds 和 error。options 中 metrics 为真时还包含各阶段耗时 stages
+    """
+    filename = image_file.name
+    stats = {'filename': filename, 'old_size': image_file.size, 'new_size': 0, 'outputs': [], 'error': None}
+    timer = _StageTimer(stats.setdefault('stages', {}) if options.get('metrics') else None)
+    start = time.perf_counter()
+    try:
+        reducing_gap = RESIZE_MODES[options.get('resize_mode', 'balanced')]
+        relative_dir, basename = os.path.split(filename)
+        stem = os.path.splitext(basename)[0]
+        # 输出目录中保持与图片目录相同的子目录结构
+        if options['output_dir']:
+            base_dir = os.path.join(options['output_dir'], relative_dir)
+            os.makedirs(base_dir, exist_ok=True)
+        else:
+            base_dir = os.path.dirname(image_file.path)
+
+        with timer.stage('open'):
+            source = Image.open(_image_source(image_file))
+        with source:
+            largest = options['renditions'][0]
+            # 在图片数据加载之前缩放到最大尺寸，JPEG 可以直接以缩小后的尺寸解码
+            current = _resize_to_fit(source, largest['width'], largest['height'], reducing_gap, timer)
+            with timer.stage('convert'):
+                # 带透明度的图片统一转换为RGBA，PNG/WebP/AVIF保留透明度，JPEG再铺上背景色
+                if current.mode == 'P':
+                    current = current.convert('RGBA' if 'transparency' in current.info else 'RGB')
+                elif current.mode in ('LA', 'PA', 'La', 'RGBa'):
+                    current = current.convert('RGBA')
+                elif current.mode not in ('RGB', 'RGBA', 'L'):
+                    current = current.convert('RGB')
+            background = options.get('background', DEFAULT_BACKGROUND)
+
+            for rendition in options['renditions']:
+                if current.width > rendition['width'] or current.height > rendition['height']:
+                    # 由上一个（更大的）尺寸逐级缩放
+                    with timer.stage('resize'):
+                        current = current.resize(_fit_size(current.size, rendition['width'], rendition['height']),
+                                                 Image.Resampling.LANCZOS)
+                flattened = None
+                for output_format in rendition['formats']:
+                    pil_format, ext = RENDITION_FORMATS[output_format]
+                    output = current
+                    if pil_format == 'JPEG' and current.mode == 'RGBA':
+                        # JPEG不支持透明度，铺上背景色（每个尺寸只处理一次）
+                        with timer.stage('convert'):
+                            if flattened is None:
+                                flattened = _flatten_alpha(current, background)
+                        output = flattened
+
+                    output_name = options['template'].format(
+                        stem=stem, name=rendition['name'], width=rendition['width'],
+                        height=rendition['height'], ext=ext)
+                    output_path = os.path.join(base_dir, output_name)
+                    quality = rendition.get('quality', options['quality'])
+                    with timer.stage('encode'):
+                        if pil_format == 'PNG':
+                            data = _encode_image(output, pil_format, optimize=True)
+                        elif pil_format == 'AVIF':
+                            data = _encode_image(output, pil_format, quality=quality, speed=AVIF_SPEED)
+                        else:
+                            data = _encode_image(output, pil_format, quality=quality, optimize=True)
+                    with timer.stage('write'):
+                        _write_file(output_path, data)
+                    stats['outputs'].append((os.path.join(relative_dir, output_name), len(data)))
+                    stats['new_size'] += len(data)
+    except MemoryError:
+        stats['error'] = "内存不足"
+    except Exception as e:
+        stats['error'] = str(e)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def _fit_size(size, max_width, max_height):
+    """计算保持宽高比、不超过最大宽高的尺寸，取整方式与 Image.thumbnail 相同"""
+    width, height = size
+    if max_width >= width and max_height >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if max_width / max_height >= aspect:
+        return round_aspect(max_height * aspect, key=lambda n: abs(aspect - n / max_height)), max_height
+    return max_width, round_aspect(max_width / aspect,
+                                   key=lambda n: 0 if n == 0 else abs(aspect - max_width / n))
+
+
+def _parse_color(value):
+    """解析命令行中的颜色，返回 (R, G, B)"""
+    from PIL import ImageColor
+    try:
+        return ImageColor.getrgb(value)[:3]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的颜色: {value}")
 
 
-def main():
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # 性能测试子命令: image_processor.py benchmark [选项]
+    if argv and argv[0] == 'benchmark':
+        from image_processor_bench import main as benchmark_main
+        benchmark_main(argv[1:])
+        return
+
+    # HTTP服务: image_processor.py serve [选项]
+    if argv and argv[0] == 'serve':
+        from image_processor_server import main as serve_main
+        serve_main(argv[1:])
+        return
+
     parser = argparse.ArgumentParser(description='批量重命名和压缩图片工具')
-    parser.add_argument('directory', help='图片目录路径')
+    parser.add_argument('directories', nargs='*', metavar='directory',
+                        help='图片目录路径，也可以是 zip/tar 压缩包，可指定多个，在同一进程中依次处理')
+    parser.add_argument('--directories-from', metavar='FILE',
+                        help='从文件读取要处理的目录，每行一个，"-" 表示从标准输入读取')
+    parser.add_argument('--recursive', action='store_true', help='递归处理子目录')
+    parser.add_argument('--include', action='append', help='只处理匹配该通配符的文件，可多次指定，例如 "*.jpg"')
+    parser.add_argument('--exclude', action='append', help='跳过匹配该通配符的文件或子目录，可多次指定')
     parser.add_argument('--rename', help='重命名模式，例如 "image_"')
     parser.add_argument('--start-number', type=int, default=1, help='重命名起始编号')
     parser.add_argument('--rename-by-date', action='store_true', help='根据拍摄日期重命名')
+    parser.add_argument('--dry-run', action='store_true', help='只输出重命名方案，不修改文件')
+    parser.add_argument('--undo-rename', action='store_true', help='撤销最近一次重命名')
     parser.add_argument('--compress', action='store_true', help='压缩图片')
     parser.add_argument('--quality', type=int, default=85, help='JPEG压缩质量 (1-100)')
     parser.add_argument('--max-width', type=int, default=1920, help='最大宽度')
     parser.add_argument('--max-height', type=int, default=1080, help='最大高度')
-    parser.add_argument('--output-dir', help='压缩图片输出目录')
+    parser.add_argument('--output-dir', help='压缩图片输出目录，以 .zip/.tar/.tar.gz 等结尾时直接写入压缩包')
+    parser.add_argument('--rendition', action='append',
+                        help='生成指定尺寸和格式的版本，可多次指定，例如 "thumb:320x320:jpeg,webp"')
+    parser.add_argument('--renditions-config', help='从JSON文件读取要生成的尺寸列表')
+    parser.add_argument('--rendition-template', default=DEFAULT_RENDITION_TEMPLATE,
+                        help='多尺寸输出的文件名模板，默认为 "{stem}_{name}.{ext}"')
+    parser.add_argument('--target-size', type=int, help='目标文件大小 (KB)，自动为每张图片选择不超过 --quality 的最高质量')
+    parser.add_argument('--resize-mode', choices=sorted(RESIZE_MODES), default='balanced',
+                        help='缩放模式: quality(质量优先), balanced(默认), fast(速度优先)')
+    parser.add_argument('--format', choices=COMPRESS_FORMATS, dest='output_format',
+                        help='压缩输出格式，auto 为每张图片自动选择最小的格式，默认PNG在质量为100时保持PNG、其余输出为JPEG')
+    parser.add_argument('--background', type=_parse_color, default=DEFAULT_BACKGROUND,
+                        help='透明图片转换为JPEG时的背景色，例如 "#ffffff" 或 "black"，默认为白色')
+    parser.add_argument('--find-duplicates', action='store_true', help='查找并列出近似重复的图片')
+    parser.add_argument('--dedup', choices=DEDUP_MODES,
+                        help='压缩时处理近似重复的图片: skip(不压缩), link(硬链接到原图的输出，需要 --output-dir)')
+    parser.add_argument('--dedup-distance', type=int, default=DEDUP_DISTANCE,
+                        help=f'视为重复的最大感知哈希距离 (0-64)，默认为{DEDUP_DISTANCE}')
+    parser.add_argument('--incremental', action='store_true', help='增量处理，跳过上次已处理且未变化的文件')
+    parser.add_argument('--resume', action='store_true', help='从上次中断的位置继续压缩或生成多尺寸版本')
+    parser.add_argument('--workers', type=int, default=1, help='并行压缩的进程数，0表示使用全部CPU核心')
+    parser.add_argument('--memory-limit', type=int,
+                        help='并行处理时的内存上限 (MB)，按估算的内存占用提交任务并限制每个工作进程的内存')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='同时执行多个操作时缓存文件内容的内存上限 (MB)，0表示不缓存')
+    parser.add_argument('--quiet', '-q', action='store_true', help='不输出每个文件的处理信息')
+    parser.add_argument('--metrics-file', help='以JSON lines格式记录每个文件各处理阶段的耗时和字节数')
+    parser.add_argument('--metrics-summary', action='store_true', help='处理结束后输出各阶段耗时汇总')
+    parser.add_argument('--timing', action='store_true',
+                        help='输出启动耗时、到处理完第一个文件的耗时以及每个目录的额外开销')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s')
+
+    directories = list(args.directories)
+    if args.directories_from:
+        try:
+            directories.extend(_read_directory_list(args.directories_from))
+        except OSError as e:
+            print(f"错误: 无法读取目录列表: {e}")
+            return 1
+    if not directories:
+        parser.error("请指定图片目录或 --directories-from")
+    output_dirs = _output_dirs(directories, args.output_dir)
+    if output_dirs is None:
+        return 1
+
+    metrics = None
+    if args.metrics_file or args.metrics_summary:
+        metrics = Metrics(jsonl_path=args.metrics_file)
+    # 多个操作都要读取图片内容时共享缓存，每个文件只读取一次（按日期重命名只读取文件头部，不计入）
+    reading_operations = [args.find_duplicates, args.compress, bool(args.rendition or args.renditions_config)]
+    use_cache = args.cache_size > 0 and sum(reading_operations) > 1
+    memory_limit = args.memory_limit * 1024 * 1024 if args.memory_limit else None
+    timer = _RunTimer() if args.timing else None
+    # 处理多个目录时共享同一个进程池，工作进程只启动一次
+    workers = args.workers or os.cpu_count() or 1
+    pool = WorkerPool(workers, memory_limit) if workers > 1 and len(directories) > 1 else None
+    # BrokenProcessPool 是 BrokenExecutor 的子类，这里不导入 concurrent.futures.process，串行处理时无需加载
+    from concurrent.futures import BrokenExecutor
+    exit_code = 0
+    try:
+        for directory, output_dir in zip(directories, output_dirs):
+            # 检查目录（或压缩包）是否存在，不存在时继续处理其他目录
+            if not os.path.isdir(directory) and not (is_archive_path(directory) and os.path.isfile(directory)):
+                print(f"错误: 目录 '{directory}' 不存在")
+                exit_code = 1
+                continue
+            if len(directories) > 1:
+                print(f"处理目录: {directory}")
+            if timer:
+                timer.start_directory(directory)
+            # 缓存以文件名为键，每个目录使用单独的缓存
+            cache = ImageCache(args.cache_size * 1024 * 1024) if use_cache else None
+            processor = ImageProcessor(directory, recursive=args.recursive, include=args.include,
+                                       exclude=args.exclude, metrics=metrics, cache=cache,
+                                       progress=timer.progress if timer else None,
+                                       memory_limit=memory_limit, pool=pool)
+            try:
+                _run_operations(processor, args, output_dir)
+            except ValueError as e:
+                print(f"错误: {e}")
+                exit_code = 1
+            except (OSError, BrokenExecutor) as e:
+                # 单个目录读写失败或工作进程异常退出时记录错误，继续处理其他目录
+                logger.error("处理目录 %s 失败: %s", directory, e)
+                exit_code = 1
+                if pool and pool.broken:
+                    pool.restart()
+            if timer:
+                timer.finish_directory()
+    finally:
+        if pool:
+            pool.shutdown()
+        if timer:
+            timer.log_summary()
+        if metrics:
+            if args.metrics_summary:
+                metrics.log_summary()
+            metrics.close()
+    return exit_code
+
+
+def _read_directory_list(path):
+    """读取目录列表文件，每行一个目录，忽略空行和以 # 开头的注释行；path 为 "-" 时读取标准输入"""
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+
+def _output_dirs(directories, output_dir):
+    """
+    每个目录的输出目录
+
+    只有一个目录时直接使用 output_dir；多个目录时输出到 output_dir 下以目录名命名的子目录，
+    避免不同目录中的同名文件和清单互相覆盖。目录名重复或输出为压缩包时输出错误并返回 None。
+    """
+    if len(directories) == 1 or not output_dir:
+        return [output_dir] * len(directories)
+    if is_archive_path(output_dir):
+        print("错误: 处理多个目录时 --output-dir 不能是压缩包")
+        return None
+    names = [os.path.basename(os.path.normpath(directory)) for directory in directories]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        print(f"错误: 多个目录的名称相同，无法区分输出目录: {', '.join(duplicates)}")
+        return None
+    return [os.path.join(output_dir, name) for name in names]
 
-    # 检查目录是否存在
-    if not os.path.isdir(args.directory):
-        print(f"错误: 目录 '{args.directory}' 不存在")
-        return
 
-    processor = ImageProcessor(args.directory)
+class _RunTimer:
+    """
+    命令行 --timing 的计时
+
+    启动耗时从模块开始导入算起（不含解释器本身的启动），到处理完第一个文件为止。
+    每个目录的额外开销为开始处理该目录到处理完其中第一个文件的时间（扫描目录、
+    读取清单、启动进程池等），没有处理任何文件的目录整个耗时都算作额外开销。
+    """
+
+    def __init__(self):
+        self.main_started = time.perf_counter()
+        self.first_file = None
+        # 每个目录: (目录, 总耗时, 额外开销)
+        self.directories = []
+        self._directory = None
+        self._started = None
+        self._first_file = None
+
+    def start_directory(self, directory):
+        self._directory = directory
+        self._started = time.perf_counter()
+        self._first_file = None
+
+    def progress(self, operation, filename):
+        if self._first_file is None:
+            self._first_file = time.perf_counter()
+            if self.first_file is None:
+                self.first_file = self._first_file
+
+    def finish_directory(self):
+        finished = time.perf_counter()
+        overhead = (self._first_file or finished) - self._started
+        self.directories.append((self._directory, finished - self._started, overhead))
+        logger.info("目录 %s: 耗时 %.1f ms，其中额外开销 %.1f ms",
+                    self._directory, (finished - self._started) * 1000, overhead * 1000)
+
+    def log_summary(self):
+        logger.warning("启动耗时: 导入模块 %.1f ms，解析参数 %.1f ms",
+                       (_IMPORT_FINISHED - _IMPORT_STARTED) * 1000, (self.main_started - _IMPORT_FINISHED) * 1000)
+        if self.first_file is not None:
+            logger.warning("从导入模块到处理完第一个文件: %.1f ms", (self.first_file - _IMPORT_STARTED) * 1000)
+        if self.directories:
+            count = len(self.directories)
+            total = sum(elapsed for _, elapsed, _ in self.directories)
+            overhead = sum(overhead for _, _, overhead in self.directories)
+            logger.warning("共处理 %d 个目录，耗时 %.1f ms；每个目录平均耗时 %.1f ms，平均额外开销 %.1f ms",
+                           count, total * 1000, total / count * 1000, overhead / count * 1000)
+
+
+def _run_operations(processor, args, output_dir=None):
+    """按命令行参数依次执行各操作，output_dir 为该目录的输出目录"""
+    if args.undo_rename:
+        processor.undo_renames()
 
     # 执行重命名操作
     if args.rename:
-        count = processor.rename_images(args.rename, args.start_number)
-        print(f"成功重命名 {count} 个文件")
+        count = processor.rename_images(args.rename, args.start_number, dry_run=args.dry_run)
+        print(f"{'计划' if args.dry_run else '成功'}重命名 {count} 个文件")
 
     if args.rename_by_date:
-        count = processor.rename_images_by_date()
-        print(f"根据日期成功重命名 {count} 个文件")
+        count = processor.rename_images_by_date(incremental=args.incremental, dry_run=args.dry_run)
+        print(f"根据日期{'计划' if args.dry_run else '成功'}重命名 {count} 个文件")
+
+    if args.find_duplicates:
+        duplicates = processor.find_duplicates(args.dedup_distance, args.workers)
+        print(f"找到 {len(duplicates)} 个重复的图片")
 
     # 执行压缩操作
     if args.compress:
+        if args.dedup == 'link' and not output_dir:
+            print("错误: --dedup link 需要指定 --output-dir")
+            return
         count = processor.compress_images(
             quality=args.quality,
             max_width=args.max_width,
             max_height=args.max_height,
-            output_dir=args.output_dir
+            output_dir=output_dir,
+            workers=args.workers,
+            resize_mode=args.resize_mode,
+            incremental=args.incremental,
+            target_size=args.target_size * 1024 if args.target_size else None,
+            resume=args.resume,
+            dedup=args.dedup,
+            dedup_distance=args.dedup_distance,
+            background=args.background,
+            output_format=args.output_format
         )
         print(f"成功压缩 {count} 个文件")
 
+    # 生成多尺寸版本
+    if args.rendition or args.renditions_config:
+        try:
+            renditions = [parse_rendition(spec) for spec in args.rendition or []]
+            if args.renditions_config:
+                renditions.extend(load_renditions(args.renditions_config))
+        except (OSError, ValueError) as e:
+            print(f"错误: 无法读取尺寸设置: {e}")
+            return
+        count = processor.create_renditions(
+            renditions,
+            output_dir=output_dir,
+            template=args.rendition_template,
+            quality=args.quality,
+            workers=args.workers,
+            resize_mode=args.resize_mode,
+            resume=args.resume,
+            background=args.background
+        )
+        print(f"成功为 {count} 个文件生成多尺寸版本")
+
+
+# 模块导入完成的时间
+_IMPORT_FINISHED = time.perf_counter()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
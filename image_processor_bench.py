@@ -0,0 +1,439 @@
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import time
+import logging
+import multiprocessing
+from datetime import datetime
+from PIL import Image
+
+from image_processor import (RESIZE_MODES, ImageProcessor, Metrics, _compress_file, _flatten_alpha, _read_exif_date,
+                             _read_exif_date_pillow, parse_rendition)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# 合成测试集中的图片类型：类型 -> (扩展名, 基准尺寸)
+CORPUS_KINDS = {
+    'jpeg_large': ('.jpg', (4000, 3000)),
+    'png_rgba': ('.png', (2000, 1500)),
+    'png_palette': ('.png', (1200, 900)),
+    'tiff': ('.tiff', (2400, 1600)),
+    'webp': ('.webp', (1600, 1200)),
+}
+
+# 测试套件中的操作
+OPERATIONS = ('compress', 'renditions', 'rename_by_date')
+
+SUITE_RENDITIONS = ['full:1920x1080:jpeg,webp', 'medium:800x800:jpeg,webp', 'thumb:320x320:webp']
+
+
+def _noise(size, rng):
+    """用固定随机种子生成可重复的平滑噪声"""
+    tile = Image.frombytes('L', (64, 64), bytes(rng.getrandbits(8) for _ in range(64 * 64)))
+    return tile.resize(size, Image.Resampling.BICUBIC)
+
+
+def _synthetic_rgb(size, rng):
+    """生成渐变叠加噪声的RGB图片，近似照片内容"""
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = _noise(size, rng)
+    red = Image.blend(gradient, noise, 0.3)
+    green = Image.blend(gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise, 0.3)
+    blue = Image.blend(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM), noise, 0.3)
+    return Image.merge('RGB', (red, green, blue))
+
+
+def make_camera_jpeg(path, size=(6000, 4000), quality=92, rng=None):
+    """
+    生成一张近似相机照片的大尺寸JPEG（渐变叠加噪声）
+
+    Args:
+        path: 输出文件路径
+        size: 图片尺寸，默认约24MP
+        quality: JPEG质量
+        rng: random.Random 实例，默认使用固定种子
+    """
+    _synthetic_rgb(size, rng or random.Random(0)).save(path, 'JPEG', quality=quality)
+
+
+def generate_corpus(directory, count=50, seed=0):
+    """
+    生成可重复的合成测试图片集
+
+    依次循环生成大尺寸JPEG（带EXIF拍摄日期）、RGBA PNG、调色板PNG、TIFF和WebP，
+    尺寸在基准尺寸上随机浮动。相同的 count 和 seed 总是生成相同的图片。
+
+    Returns:
+        int: 测试集的总字节数
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    kinds = list(CORPUS_KINDS)
+    total_bytes = 0
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        ext, (base_width, base_height) = CORPUS_KINDS[kind]
+        scale = rng.uniform(0.75, 1.25)
+        size = (int(base_width * scale), int(base_height * scale))
+        path = os.path.join(directory, f"{kind}_{i:05d}{ext}")
+
+        image = _synthetic_rgb(size, rng)
+        if kind == 'jpeg_large':
+            exif = image.getexif()
+            date = f"2023:{rng.randint(1, 12):02d}:{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:00:00"
+            exif[0x0132] = date
+            exif.get_ifd(0x8769)[0x9003] = date
+            image.save(path, 'JPEG', quality=92, exif=exif)
+        elif kind == 'png_rgba':
+            image.putalpha(_noise(size, rng))
+            image.save(path, 'PNG')
+        elif kind == 'png_palette':
+            image.quantize(64).save(path, 'PNG')
+        elif kind == 'tiff':
+            image.save(path, 'TIFF')
+        else:
+            image.save(path, 'WEBP', quality=90)
+        total_bytes += os.path.getsize(path)
+    return total_bytes
+
+
+def _peak_rss_mb():
+    """当前进程及其已结束子进程的峰值内存（MB），不支持时返回None"""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # macOS 以字节为单位，Linux 以KB为单位
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _percentile(values, percent):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, int(round(percent / 100 * len(ordered) + 0.5)) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def _run_operation(operation, corpus_dir, workers, conn):
+    """
+    在独立的子进程中对测试集副本执行一个操作，使峰值内存互不影响
+
+    结果通过 conn 发送回父进程。
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = os.path.join(tmp, 'work')
+        shutil.copytree(corpus_dir, work_dir)
+        # 通过指标回调记录每张图片的耗时
+        latencies = []
+        metrics = Metrics(hook=lambda record: latencies.append(record['seconds']))
+        processor = ImageProcessor(work_dir, metrics=metrics)
+        image_files = list(processor.iter_image_files())
+        input_bytes = sum(image_file.size for image_file in image_files)
+
+        # 只计算处理本身的耗时，不输出每个文件的处理信息
+        logging.getLogger('image_processor').setLevel(logging.WARNING)
+        start = time.perf_counter()
+        if operation == 'compress':
+            count = processor.compress_images(output_dir=os.path.join(tmp, 'out'), workers=workers)
+        elif operation == 'renditions':
+            renditions = [parse_rendition(spec) for spec in SUITE_RENDITIONS]
+            count = processor.create_renditions(renditions, output_dir=os.path.join(tmp, 'out'),
+                                                workers=workers)
+        else:
+            count = processor.rename_images_by_date()
+        seconds = time.perf_counter() - start
+
+    p50 = _percentile(latencies, 50)
+    p95 = _percentile(latencies, 95)
+    conn.send({
+        'images': len(image_files),
+        'processed': count,
+        'input_bytes': input_bytes,
+        'seconds': seconds,
+        'images_per_sec': len(image_files) / seconds if seconds else None,
+        'mb_per_sec': input_bytes / (1024 * 1024) / seconds if seconds else None,
+        'p50_ms': p50 * 1000 if p50 is not None else None,
+        'p95_ms': p95 * 1000 if p95 is not None else None,
+        'peak_rss_mb': _peak_rss_mb(),
+    })
+    conn.close()
+
+
+def run_suite(corpus_dir, operations=OPERATIONS, workers=1):
+    """
+    依次在子进程中执行各操作并收集指标
+
+    Returns:
+        dict: 操作 -> 指标 (images, processed, input_bytes, seconds, images_per_sec,
+            mb_per_sec, p50_ms, p95_ms, peak_rss_mb)
+    """
+    results = {}
+    for operation in operations:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_run_operation, args=(operation, corpus_dir, workers, sender))
+        process.start()
+        sender.close()
+        try:
+            results[operation] = receiver.recv()
+        except EOFError:
+            raise RuntimeError(f"测试 {operation} 异常退出")
+        finally:
+            process.join()
+    return results
+
+
+def _format_metric(value, spec):
+    if value is None:
+        return '-'.rjust(int(spec.split('.')[0]))
+    return format(value, spec)
+
+
+def print_results(results, baseline=None):
+    """输出测试结果，指定了 baseline 时同时显示与之相比的吞吐量变化"""
+    print(f"{'操作':<16}{'图片/秒':>10}{'MB/秒':>10}{'p50 ms':>10}{'p95 ms':>10}{'峰值内存MB':>12}")
+    for operation, metrics in results.items():
+        line = (f"{operation:<16}"
+                f"{_format_metric(metrics['images_per_sec'], '10.2f')}"
+                f"{_format_metric(metrics['mb_per_sec'], '10.2f')}"
+                f"{_format_metric(metrics['p50_ms'], '10.1f')}"
+                f"{_format_metric(metrics['p95_ms'], '10.1f')}"
+                f"{_format_metric(metrics['peak_rss_mb'], '12.1f')}")
+        previous = (baseline or {}).get(operation)
+        if previous and previous.get('images_per_sec') and metrics['images_per_sec']:
+            change = (metrics['images_per_sec'] / previous['images_per_sec'] - 1) * 100
+            line += f"  ({change:+.1f}%)"
+        print(line)
+
+
+def bench_resize_modes(count=5, size=(6000, 4000), max_width=1920, max_height=1080, quality=85):
+    """
+    比较不同缩放模式压缩大尺寸JPEG的速度
+
+    Returns:
+        dict: 缩放模式 -> 每张图片的平均耗时（秒）
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        source_dir = os.path.join(tmp, 'src')
+        os.makedirs(source_dir)
+        rng = random.Random(0)
+        for i in range(count):
+            make_camera_jpeg(os.path.join(source_dir, f"camera_{i}.jpg"), size, rng=rng)
+        sources = list(ImageProcessor(source_dir).iter_image_files())
+
+        for mode in RESIZE_MODES:
+            output_dir = os.path.join(tmp, mode)
+            os.makedirs(output_dir)
+            options = {
+                'quality': quality,
+                'max_width': max_width,
+                'max_height': max_height,
+                'output_dir': output_dir,
+                'resize_mode': mode,
+            }
+            start = time.perf_counter()
+            for image_file in sources:
+                stats = _compress_file(image_file, options)
+                if stats['error']:
+                    raise RuntimeError(f"压缩 {image_file.name} 时出错: {stats['error']}")
+            results[mode] = (time.perf_counter() - start) / count
+
+    baseline = results['quality']
+    print(f"缩放模式测试: {count} 张 {size[0]}x{size[1]} JPEG -> {max_width}x{max_height}")
+    for mode, seconds in results.items():
+        print(f"  {mode:<10} {seconds * 1000:8.1f} ms/张  加速 {baseline / seconds:.2f}x")
+    return results
+
+
+def bench_capture_date(count=10000):
+    """
+    比较直接读取EXIF文件头与通过Pillow读取EXIF获取拍摄日期的速度
+
+    Returns:
+        dict: 读取方式 -> 每张图片的平均耗时（秒）
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        template = os.path.join(tmp, 'template.jpg')
+        image = Image.new('RGB', (640, 480), (128, 128, 128))
+        exif = image.getexif()
+        exif[0x0132] = "2023:12:01 12:30:45"
+        exif.get_ifd(0x8769)[0x9003] = "2023:12:01 12:30:45"
+        image.save(template, 'JPEG', exif=exif)
+
+        paths = []
+        for i in range(count):
+            path = os.path.join(tmp, f"photo_{i}.jpg")
+            shutil.copyfile(template, path)
+            paths.append(path)
+
+        for name, reader in (('pillow', _read_exif_date_pillow), ('header', _read_exif_date)):
+            start = time.perf_counter()
+            for path in paths:
+                if reader(path) is None:
+                    raise RuntimeError(f"无法读取 {path} 的拍摄日期")
+            results[name] = (time.perf_counter() - start) / count
+
+    print(f"EXIF日期读取测试: {count} 张JPEG")
+    for name, seconds in results.items():
+        print(f"  {name:<10} {seconds * 1e6:8.1f} us/张  加速 {results['pillow'] / seconds:.2f}x")
+    return results
+
+
+def _flatten_alpha_split(img):
+    """原先的透明度处理方式：split() 出全部通道，再以 alpha 通道为蒙版粘贴到白色背景上"""
+    background = Image.new('RGB', img.size, (255, 255, 255))
+    background.paste(img, mask=img.split()[-1])
+    return background
+
+
+def _run_flatten(method, size, repeat, conn):
+    """在独立的子进程中测量一种透明度处理方式的耗时和额外峰值内存"""
+    rng = random.Random(0)
+    rgb = _synthetic_rgb(size, rng)
+    rgb.putalpha(_noise(size, rng))
+    flatten = _flatten_alpha_split if method == 'split' else _flatten_alpha
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        flatten(rgb)
+    seconds = (time.perf_counter() - start) / repeat
+    peak = _peak_rss_mb()
+    conn.send({
+        'seconds': seconds,
+        'extra_peak_mb': peak - baseline if peak is not None else None,
+    })
+    conn.close()
+
+
+def bench_flatten(size=(7680, 4320), repeat=3):
+    """
+    比较原先的 split() 方式与 _flatten_alpha 把大尺寸RGBA图片铺到背景色上的耗时和内存
+
+    每种方式在独立的子进程中执行，额外峰值内存为处理前后进程峰值内存之差。
+
+    Returns:
+        dict: 处理方式 -> (seconds, extra_peak_mb)
+    """
+    results = {}
+    for method in ('split', 'flatten'):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_run_flatten, args=(method, size, repeat, sender))
+        process.start()
+        sender.close()
+        try:
+            results[method] = receiver.recv()
+        except EOFError:
+            raise RuntimeError(f"测试 {method} 异常退出")
+        finally:
+            process.join()
+
+    baseline = results['split']['seconds']
+    print(f"透明度处理测试: {size[0]}x{size[1]} RGBA -> RGB")
+    for method, item in results.items():
+        print(f"  {method:<10} {item['seconds'] * 1000:8.1f} ms/张  加速 {baseline / item['seconds']:.2f}x  "
+              f"额外峰值内存 {_format_metric(item['extra_peak_mb'], '8.1f')} MB")
+    return results
+
+
+def bench_suite(count=50, seed=0, workers=1, operations=OPERATIONS, corpus_dir=None, output=None, compare=None):
+    """
+    生成合成测试集并运行完整的测试套件
+
+    Args:
+        count: 测试集图片数量
+        seed: 随机种子
+        workers: 传给各操作的并行进程数
+        operations: 要执行的操作
+        corpus_dir: 测试集目录，已存在时直接使用，否则在此生成；为None时使用临时目录
+        output: 保存JSON结果的文件路径
+        compare: 之前保存的JSON结果，用于比较吞吐量
+    """
+    baseline = None
+    if compare:
+        with open(compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f).get('results')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if corpus_dir is None:
+            corpus_dir = os.path.join(tmp, 'corpus')
+        if not os.path.isdir(corpus_dir) or not os.listdir(corpus_dir):
+            print(f"生成测试集: {count} 张图片 (seed={seed})")
+            generate_corpus(corpus_dir, count=count, seed=seed)
+        results = run_suite(corpus_dir, operations=operations, workers=workers)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'count': count,
+            'seed': seed,
+            'workers': workers,
+        },
+        'results': results,
+    }
+    print_results(results, baseline)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"结果已保存到 {output}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='图片处理性能测试')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='要运行的测试: suite(完整测试套件，默认), resize(缩放模式), exif(EXIF日期读取), '
+                             'flatten(透明度处理)')
+    parser.add_argument('--count', type=int, default=50, help='测试集图片数量')
+    parser.add_argument('--seed', type=int, default=0, help='生成测试集的随机种子')
+    parser.add_argument('--workers', type=int, default=1, help='并行进程数，0表示使用全部CPU核心')
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help=f"要执行的操作，逗号分隔，默认为 {','.join(OPERATIONS)}")
+    parser.add_argument('--corpus-dir', help='测试集目录，不存在时在此生成，便于多次运行复用')
+    parser.add_argument('--output', help='保存JSON结果的文件路径')
+    parser.add_argument('--compare', help='与之前保存的JSON结果比较')
+    parser.add_argument('--resize-count', type=int, default=5, help='缩放测试的图片数量')
+    parser.add_argument('--width', type=int, default=6000, help='缩放测试的图片宽度')
+    parser.add_argument('--height', type=int, default=4000, help='缩放测试的图片高度')
+    parser.add_argument('--exif-count', type=int, default=10000, help='EXIF读取测试的图片数量')
+    parser.add_argument('--flatten-width', type=int, default=7680, help='透明度处理测试的图片宽度')
+    parser.add_argument('--flatten-height', type=int, default=4320, help='透明度处理测试的图片高度')
+
+    args = parser.parse_args(argv)
+    benchmarks = args.benchmarks or ['suite']
+    for name in benchmarks:
+        if name not in ('suite', 'resize', 'exif', 'flatten'):
+            parser.error(f"未知的测试: {name}")
+    operations = [operation.strip() for operation in args.operations.split(',') if operation.strip()]
+    for operation in operations:
+        if operation not in OPERATIONS:
+            parser.error(f"未知的操作: {operation}")
+
+    if 'suite' in benchmarks:
+        bench_suite(count=args.count, seed=args.seed, workers=args.workers, operations=operations,
+                    corpus_dir=args.corpus_dir, output=args.output, compare=args.compare)
+    if 'resize' in benchmarks:
+        bench_resize_modes(count=args.resize_count, size=(args.width, args.height))
+    if 'exif' in benchmarks:
+        bench_capture_date(count=args.exif_count)
+    if 'flatten' in benchmarks:
+        bench_flatten(size=(args.flatten_width, args.flatten_height))
+
+
+if __name__ == "__main__":
+    main()
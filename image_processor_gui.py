@@ -1,7 +1,31 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
-from image_processor import ImageProcessor
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from image_processor import ImageProcessor, logger
+
+# 界面每隔多少毫秒从队列中取一次消息
+POLL_INTERVAL_MS = 100
+# 日志区域最多保留的行数，超出后删除最早的行
+MAX_LOG_LINES = 2000
+
+
+class _QueueLogHandler(logging.Handler):
+    """把日志消息放入队列，由界面线程取出显示"""
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def emit(self, record):
+        try:
+            self.events.put(('log', self.format(record)))
+        except Exception:
+            self.handleError(record)
 
 
 class ImageProcessorGUI:
@@ -21,8 +45,23 @@ class ImageProcessorGUI:
         self.rename_by_date = tk.BooleanVar()
         self.rename_enabled = tk.BooleanVar()
         self.compress_enabled = tk.BooleanVar()
-        
+
+        # 处理在后台线程中进行，通过队列把日志和进度传回界面线程
+        self.events = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.cancel_event = threading.Event()
+        self.running = False
+        self.progress_var = tk.DoubleVar()
+        self.progress_text = tk.StringVar()
+
+        self.log_handler = _QueueLogHandler(self.events)
+        self.log_handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(self.log_handler)
+        logger.setLevel(logging.INFO)
+
         self.create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after(POLL_INTERVAL_MS, self.poll_events)
         
     def create_widgets(self):
         # 主框架
@@ -80,12 +119,22 @@ class ImageProcessorGUI:
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=2, column=0, columnspan=2, pady=(10, 0))
         
-        ttk.Button(button_frame, text="开始处理", command=self.process_images).grid(row=0, column=0, padx=(0, 10))
-        ttk.Button(button_frame, text="退出", command=self.root.quit).grid(row=0, column=1)
-        
+        self.start_button = ttk.Button(button_frame, text="开始处理", command=self.process_images)
+        self.start_button.grid(row=0, column=0, padx=(0, 10))
+        self.cancel_button = ttk.Button(button_frame, text="取消", command=self.cancel, state=tk.DISABLED)
+        self.cancel_button.grid(row=0, column=1, padx=(0, 10))
+        ttk.Button(button_frame, text="退出", command=self.close).grid(row=0, column=2)
+
+        # 进度
+        progress_frame = ttk.Frame(main_frame)
+        progress_frame.grid(row=3, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
+        ttk.Progressbar(progress_frame, variable=self.progress_var, maximum=100).grid(row=0, column=0, sticky=(tk.W, tk.E))
+        ttk.Label(progress_frame, textvariable=self.progress_text).grid(row=1, column=0, sticky=tk.W)
+        progress_frame.columnconfigure(0, weight=1)
+
         # 日志区域
         log_frame = ttk.LabelFrame(main_frame, text="处理日志", padding="10")
-        log_frame.grid(row=3, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(10, 0))
+        log_frame.grid(row=4, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(10, 0))
         
         self.log_text = tk.Text(log_frame, height=10, state=tk.DISABLED)
         scrollbar = ttk.Scrollbar(log_frame, orient=tk.VERTICAL, command=self.log_text.yview)
@@ -99,7 +148,7 @@ class ImageProcessorGUI:
         self.root.rowconfigure(0, weight=1)
         main_frame.columnconfigure(0, weight=1)
         main_frame.columnconfigure(1, weight=1)
-        main_frame.rowconfigure(3, weight=1)
+        main_frame.rowconfigure(4, weight=1)
         dir_frame.columnconfigure(0, weight=1)
         rename_frame.columnconfigure(0, weight=1)
         compress_frame.columnconfigure(0, weight=1)
@@ -147,10 +196,74 @@ class ImageProcessorGUI:
     def log(self, message):
         self.log_text.config(state=tk.NORMAL)
         self.log_text.insert(tk.END, message + "\n")
+        # 只保留最近的 MAX_LOG_LINES 行，避免大批量处理时文本控件越来越慢
+        line_count = int(self.log_text.index('end-1c').split('.')[0])
+        if line_count > MAX_LOG_LINES:
+            self.log_text.delete('1.0', f"{line_count - MAX_LOG_LINES + 1}.0")
         self.log_text.config(state=tk.DISABLED)
         self.log_text.see(tk.END)
-        self.root.update_idletasks()
-        
+
+    def poll_events(self):
+        """取出后台线程发来的全部消息，日志合并为一次插入，进度只显示最新的一条"""
+        lines = []
+        progress = None
+        finished = None
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event[0] == 'log':
+                    lines.append(event[1])
+                elif event[0] == 'progress':
+                    progress = event[1:]
+                else:
+                    finished = event
+        except queue.Empty:
+            pass
+
+        if lines:
+            self.log("\n".join(lines[-MAX_LOG_LINES:]))
+        if progress:
+            self.show_progress(*progress)
+        if finished:
+            self.finish(*finished)
+        self.root.after(POLL_INTERVAL_MS, self.poll_events)
+
+    def show_progress(self, label, done, total, started):
+        elapsed = time.perf_counter() - started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        text = f"{label}: {done}/{total}，{rate:.1f} 张/秒"
+        if rate > 0 and total > done:
+            remaining = int((total - done) / rate)
+            text += f"，剩余 {remaining // 60}:{remaining % 60:02d}"
+        self.progress_var.set(done * 100 / total if total else 100)
+        self.progress_text.set(text)
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.cancel_button.config(state=tk.DISABLED)
+        self.progress_text.set("正在取消，等待当前文件处理完成...")
+
+    def close(self):
+        if self.running:
+            # 先停止后台处理，完成后再关闭窗口
+            self.cancel()
+            self.root.after(POLL_INTERVAL_MS, self.close)
+            return
+        logger.removeHandler(self.log_handler)
+        self.executor.shutdown(wait=False)
+        self.root.destroy()
+
+    def finish(self, kind, message):
+        self.running = False
+        self.start_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        if kind == 'error':
+            messagebox.showerror("错误", f"处理过程中出现错误:\n{message}")
+        elif self.cancel_event.is_set():
+            self.progress_text.set("已取消")
+        else:
+            messagebox.showinfo("完成", message)
+
     def process_images(self):
         if not self.directory.get():
             messagebox.showerror("错误", "请选择图片目录")
@@ -164,33 +277,74 @@ class ImageProcessorGUI:
             messagebox.showwarning("警告", "请选择至少一个操作（重命名或压缩）")
             return
             
+        settings = {
+            'directory': self.directory.get(),
+            'rename_enabled': self.rename_enabled.get(),
+            'rename_by_date': self.rename_by_date.get(),
+            'rename_pattern': self.rename_pattern.get(),
+            'compress_enabled': self.compress_enabled.get(),
+            'output_dir': self.output_dir.get() or None,
+        }
         try:
-            processor = ImageProcessor(self.directory.get())
-            
+            # Tk 变量只能在界面线程中读取
+            settings.update(start_number=self.start_number.get(), quality=self.quality.get(),
+                            max_width=self.max_width.get(), max_height=self.max_height.get())
+        except tk.TclError:
+            messagebox.showerror("错误", "请输入有效的数字")
+            return
+
+        self.running = True
+        self.cancel_event.clear()
+        self.start_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_var.set(0)
+        self.progress_text.set("")
+        self.executor.submit(self.run_batch, settings)
+
+    def run_batch(self, settings):
+        """在后台线程中执行处理，结果通过队列发回界面线程"""
+        try:
+            started = {}
+            done = {}
+            total = {}
+            labels = {'rename': "重命名", 'rename_by_date': "按日期重命名", 'compress': "压缩"}
+
+            def progress(operation, filename):
+                if operation not in started:
+                    started[operation] = time.perf_counter()
+                    done[operation] = 0
+                done[operation] += 1
+                self.events.put(('progress', labels[operation], done[operation], total[operation],
+                                 started[operation]))
+
+            processor = ImageProcessor(settings['directory'], progress=progress, cancel_event=self.cancel_event)
+
             # 执行重命名操作
-            if self.rename_enabled.get():
-                if self.rename_by_date.get():
+            if settings['rename_enabled']:
+                operation = 'rename_by_date' if settings['rename_by_date'] else 'rename'
+                total[operation] = len(processor.get_image_files())
+                if settings['rename_by_date']:
                     count = processor.rename_images_by_date()
-                    self.log(f"根据日期成功重命名 {count} 个文件")
+                    logger.info("根据日期成功重命名 %d 个文件", count)
                 else:
-                    count = processor.rename_images(self.rename_pattern.get(), self.start_number.get())
-                    self.log(f"成功重命名 {count} 个文件")
-                    
+                    count = processor.rename_images(settings['rename_pattern'], settings['start_number'])
+                    logger.info("成功重命名 %d 个文件", count)
+
             # 执行压缩操作
-            if self.compress_enabled.get():
-                output_dir = self.output_dir.get() if self.output_dir.get() else None
+            if settings['compress_enabled'] and not self.cancel_event.is_set():
+                total['compress'] = len(processor.get_image_files())
                 count = processor.compress_images(
-                    quality=self.quality.get(),
-                    max_width=self.max_width.get(),
-                    max_height=self.max_height.get(),
-                    output_dir=output_dir
+                    quality=settings['quality'],
+                    max_width=settings['max_width'],
+                    max_height=settings['max_height'],
+                    output_dir=settings['output_dir']
                 )
-                self.log(f"成功压缩 {count} 个文件")
-                
-            messagebox.showinfo("完成", "图片处理完成")
-            
+                logger.info("成功压缩 %d 个文件", count)
+
+            self.events.put(('done', "图片处理完成"))
+
         except Exception as e:
-            messagebox.showerror("错误", f"处理过程中出现错误:\n{str(e)}")
+            self.events.put(('error', str(e)))
 
 
 def main():
@@ -0,0 +1,532 @@
+import os
+import json
+import math
+import time
+import uuid
+import asyncio
+import argparse
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qsl
+
+from image_processor import (COMPRESS_FORMATS, DEFAULT_BACKGROUND, DEFAULT_RENDITION_TEMPLATE, RESIZE_MODES, ImageFile,
+                             ImageProcessor, Metrics, WorkerPool, _compress_file, parse_rendition)
+
+logger = logging.getLogger('image_processor.server')
+
+# 单个请求体的大小上限（字节）
+MAX_BODY_SIZE = 64 * 1024 * 1024
+# 请求头的数量上限
+MAX_HEADERS = 100
+# 读取请求头（包括 keep-alive 连接等待下一个请求）和请求体的超时时间（秒）
+READ_TIMEOUT = 30
+# 同时保持的连接数上限，超出时直接返回 503 并关闭连接
+MAX_CONNECTIONS = 256
+# 保留的已结束批处理任务数，超出后删除最早的记录
+JOB_HISTORY = 1000
+# 缩略图的默认最大尺寸
+DEFAULT_THUMBNAIL_SIZE = 320
+
+# 输出文件扩展名 -> Content-Type
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+}
+
+# 批处理任务支持的操作
+JOB_OPERATIONS = ('compress', 'rename', 'rename_by_date', 'renditions')
+
+# 需要占用排队名额的接口，在读取请求体之前检查
+QUEUED_PATHS = ('/compress', '/thumbnail', '/jobs')
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+def _run_job(operation, directory, params):
+    """
+    在进程池中执行一个目录批处理任务，定义在模块级别以便在子进程中执行
+
+    Returns:
+        dict: count（成功处理的文件数）和 errors（出错的文件及原因）
+    """
+    processor = ImageProcessor(directory, recursive=params.get('recursive', False),
+                               include=params.get('include'), exclude=params.get('exclude'))
+    errors = []
+    if operation == 'compress':
+        count = processor.compress_images(
+            quality=params.get('quality', 85),
+            max_width=params.get('max_width', 1920),
+            max_height=params.get('max_height', 1080),
+            output_dir=params.get('output_dir'),
+            resize_mode=params.get('resize_mode', 'balanced'),
+            incremental=params.get('incremental', False),
+            target_size=params['target_size'] * 1024 if params.get('target_size') else None,
+            background=params.get('background', DEFAULT_BACKGROUND),
+            output_format=params.get('format')
+        )
+        errors = [(stats['filename'], stats['error']) for stats in processor.compress_stats if stats['error']]
+    elif operation == 'rename':
+        count = processor.rename_images(params['pattern'], params.get('start_number', 1),
+                                        dry_run=params.get('dry_run', False))
+    elif operation == 'rename_by_date':
+        count = processor.rename_images_by_date(incremental=params.get('incremental', False),
+                                                dry_run=params.get('dry_run', False))
+    else:
+        renditions = [parse_rendition(spec) for spec in params['renditions']]
+        count = processor.create_renditions(
+            renditions,
+            output_dir=params.get('output_dir'),
+            template=params.get('template', DEFAULT_RENDITION_TEMPLATE),
+            quality=params.get('quality', 85),
+            resize_mode=params.get('resize_mode', 'balanced'),
+            background=params.get('background', DEFAULT_BACKGROUND)
+        )
+        errors = [(stats['filename'], stats['error']) for stats in processor.rendition_stats if stats['error']]
+    return {'count': count, 'errors': errors}
+
+
+class ImageServer:
+    """
+    常驻的图片处理HTTP服务
+
+    单张图片的压缩和缩略图请求以及目录批处理任务都在同一个进程池中执行，
+    进程池和 Pillow 只需初始化一次。排队和执行中的任务数达到 max_pending 时
+    直接返回 503，调用方稍后重试。名额在读取请求体之前检查，连接数和读取时间也有上限，
+    服务本身的内存占用不会随请求量或慢速客户端增长。
+    工作进程异常退出时只有当时在执行的请求或任务失败，进程池随即重建。
+
+    接口：
+        POST /compress?filename=&quality=&max_width=&max_height=&resize_mode=&target_size=&format=
+            请求体为图片内容，返回压缩后的图片
+        POST /thumbnail?filename=&width=&height=&quality=&format=
+            请求体为图片内容，返回缩略图
+        POST /jobs  请求体为JSON {"operation": ..., "directory": ..., 其他参数}，返回任务ID
+        GET /jobs/<id>  查询批处理任务的状态和结果
+        GET /metrics  请求计数、排队情况和各处理阶段的耗时汇总
+        GET /health  服务和进程池的状态，进程池不可用时返回 503 并重建进程池
+    """
+
+    def __init__(self, workers=None, max_pending=None, max_connections=MAX_CONNECTIONS):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.max_connections = max_connections
+        self.connections = 0
+        self.pool = None
+        # 已提交到进程池、尚未完成的任务，关闭服务时取消其中还在排队的任务
+        self.futures = set()
+        self.pending = 0
+        self.jobs = OrderedDict()
+        self.metrics = Metrics()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'rejected': 0, 'errors': 0}
+
+    async def start(self, host='127.0.0.1', port=8080):
+        # fork 出的工作进程会继承监听套接字和当时打开的连接，连接关闭后客户端仍收不到EOF，
+        # 因此通过 forkserver 创建工作进程，并在开始监听之前启动它
+        mp_context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+        self.pool = WorkerPool(self.workers, mp_context=mp_context)
+        await asyncio.wrap_future(self.pool.executor.submit(os.getpid))
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        if self.pool:
+            self.pool.shutdown()
+
+    def reserve(self):
+        """占用一个排队名额，超过排队上限时拒绝"""
+        if self.pending >= self.max_pending:
+            self.counters['rejected'] += 1
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "服务繁忙，请稍后重试")
+        self.pending += 1
+        return _Reservation(self)
+
+    async def submit(self, func, *args):
+        """
+        在进程池中执行，调用方需要持有 reserve() 得到的名额
+
+        进程池在之前的请求中损坏时先重建再提交；执行期间工作进程异常退出时重建进程池，
+        本次请求以错误结束。
+        """
+        executor = self.pool.executor
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self.pool.restart(executor)
+            executor = self.pool.executor
+            future = executor.submit(func, *args)
+        self.futures.add(future)
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self.pool.restart(executor)
+            raise RuntimeError("工作进程异常退出")
+        finally:
+            self.futures.discard(future)
+
+    async def handle_connection(self, reader, writer):
+        """处理一个连接，支持 keep-alive 连续处理多个请求"""
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                self.counters['rejected'] += 1
+                await _send_json(writer, HTTPStatus.SERVICE_UNAVAILABLE, {'error': "连接数过多，请稍后重试"},
+                                 keep_alive=False, headers={'Retry-After': '1'})
+                return
+            while True:
+                try:
+                    # 空闲的 keep-alive 连接超时后关闭
+                    head = await asyncio.wait_for(_read_head(reader), READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                except HTTPError as e:
+                    await _send_json(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    break
+                if head is None:
+                    break
+                method, target, headers, length = head
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self.counters['requests'] += 1
+                reservation = None
+                body = None
+                try:
+                    if method == 'POST' and _path(target) in QUEUED_PATHS:
+                        # 先占用名额再读取请求体，繁忙时不必接收可能很大的请求体
+                        reservation = self.reserve()
+                    try:
+                        body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT) if length else b''
+                    except asyncio.TimeoutError:
+                        raise HTTPError(HTTPStatus.REQUEST_TIMEOUT, "读取请求体超时")
+                    status, content_type, payload, extra_headers = await self.dispatch(
+                        method, target, body, reservation)
+                except HTTPError as e:
+                    status, content_type, payload, extra_headers = (
+                        e.status, 'application/json', _json_bytes({'error': str(e)}), {})
+                    if body is None and length:
+                        # 请求体未读取（或未读完），连接中剩余的数据无法再作为下一个请求解析
+                        keep_alive = False
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    logger.exception("处理请求 %s %s 时出错", method, target)
+                    self.counters['errors'] += 1
+                    status, content_type, payload, extra_headers = (
+                        HTTPStatus.INTERNAL_SERVER_ERROR, 'application/json', _json_bytes({'error': str(e)}), {})
+                finally:
+                    if reservation is not None:
+                        reservation.release()
+                if status == HTTPStatus.SERVICE_UNAVAILABLE:
+                    extra_headers = dict(extra_headers, **{'Retry-After': '1'})
+                await _send(writer, status, content_type, payload, extra_headers, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def dispatch(self, method, target, body, reservation=None):
+        """处理一个请求，reservation 为 QUEUED_PATHS 中的接口已占用的排队名额"""
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        path = _path(target)
+
+        if path == '/health' and method == 'GET':
+            pool = {'workers': self.workers, 'restarts': self.pool.restarts, 'broken': self.pool.broken}
+            if pool['broken']:
+                # 本次报告不可用并立即重建进程池，没有其他请求时也能恢复
+                self.pool.restart()
+                return HTTPStatus.SERVICE_UNAVAILABLE, 'application/json', _json_bytes(
+                    {'status': 'unavailable', 'pool': pool}), {}
+            return HTTPStatus.OK, 'application/json', _json_bytes({'status': 'ok', 'pool': pool}), {}
+        if path == '/metrics' and method == 'GET':
+            return HTTPStatus.OK, 'application/json', _json_bytes(self.status()), {}
+        if path in ('/compress', '/thumbnail'):
+            if method != 'POST':
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            return await self.compress(path.lstrip('/'), query, body)
+        if path == '/jobs' and method == 'POST':
+            job = self.create_job(body, reservation)
+            return HTTPStatus.ACCEPTED, 'application/json', _json_bytes(job), {}
+        if path.startswith('/jobs/') and method == 'GET':
+            job = self.jobs.get(path[len('/jobs/'):])
+            if job is None:
+                raise HTTPError(HTTPStatus.NOT_FOUND, "任务不存在")
+            return HTTPStatus.OK, 'application/json', _json_bytes(job), {}
+        raise HTTPError(HTTPStatus.NOT_FOUND)
+
+    async def compress(self, operation, query, body):
+        """压缩请求体中的单张图片，缩略图即尺寸较小的压缩"""
+        if not body:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "请求体为空")
+        filename = os.path.basename(query.get('filename', 'upload.jpg'))
+        if operation == 'thumbnail':
+            max_width = _int_param(query, 'width', DEFAULT_THUMBNAIL_SIZE)
+            max_height = _int_param(query, 'height', max_width)
+        else:
+            max_width = _int_param(query, 'max_width', 1920)
+            max_height = _int_param(query, 'max_height', 1080)
+        resize_mode = query.get('resize_mode', 'balanced')
+        if resize_mode not in RESIZE_MODES:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"不支持的缩放模式: {resize_mode}")
+        target_size = _int_param(query, 'target_size', 0)
+        output_format = query.get('format') or None
+        if output_format not in (None,) + COMPRESS_FORMATS:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"不支持的输出格式: {output_format}")
+        if target_size and output_format not in (None, 'jpeg'):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "目标文件大小只支持JPEG输出")
+        options = {
+            'quality': _int_param(query, 'quality', 85),
+            'max_width': max_width,
+            'max_height': max_height,
+            'output_dir': None,
+            'resize_mode': resize_mode,
+            'target_size': target_size * 1024 if target_size else None,
+            'output_format': output_format,
+            'archive_output': True,
+            'metrics': True,
+        }
+        options['background'] = _color_param(query.get('background'))
+        image_file = ImageFile(filename, filename, len(body), time.time_ns(), body)
+        stats = await self.submit(_compress_file, image_file, options)
+        data = stats.pop('data', None)
+        self.metrics.add(operation, stats)
+        if stats['error']:
+            raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, stats['error'])
+        extension = os.path.splitext(stats['output_name'])[1].lower()
+        headers = {
+            'X-Original-Size': str(stats['old_size']),
+            'X-Processing-Seconds': f"{stats['seconds']:.4f}",
+        }
+        if 'quality' in stats:
+            headers['X-Quality'] = str(stats['quality'])
+        return HTTPStatus.OK, CONTENT_TYPES.get(extension, 'image/jpeg'), data, headers
+
+    def create_job(self, body, reservation):
+        """
+        创建目录批处理任务，立即返回任务信息，任务在进程池中执行
+
+        请求的排队名额转交给任务，任务结束后才释放，已接受的任务不会再因为繁忙而失败。
+        """
+        try:
+            params = json.loads(body or b'{}')
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "请求体不是有效的JSON")
+        if not isinstance(params, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "请求体必须是JSON对象")
+        operation = params.pop('operation', None)
+        directory = params.pop('directory', None)
+        if operation not in JOB_OPERATIONS:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"不支持的操作: {operation}")
+        if not directory or not os.path.exists(directory):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"目录不存在: {directory}")
+        if operation == 'rename' and not params.get('pattern'):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "缺少 pattern")
+        if operation == 'renditions' and not params.get('renditions'):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "缺少 renditions")
+        if params.get('format') not in (None,) + COMPRESS_FORMATS:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"不支持的输出格式: {params['format']}")
+        if 'background' in params:
+            params['background'] = _color_param(params['background'])
+
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'operation': operation,
+            'directory': directory,
+            'status': 'queued',
+            'created': time.time(),
+        }
+        self.jobs[job_id] = job
+        self._trim_jobs()
+        asyncio.get_running_loop().create_task(self._run_job(job, params, reservation.transfer()))
+        return job
+
+    async def _run_job(self, job, params, reservation):
+        job['status'] = 'running'
+        start = time.perf_counter()
+        try:
+            job['result'] = await self.submit(_run_job, job['operation'], job['directory'], params)
+            job['status'] = 'done'
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        finally:
+            reservation.release()
+        job['seconds'] = time.perf_counter() - start
+
+    def _trim_jobs(self):
+        """删除最早的已结束任务，使保留的任务数不超过 JOB_HISTORY"""
+        if len(self.jobs) <= JOB_HISTORY:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items() if job['status'] in ('done', 'failed')]:
+            del self.jobs[job_id]
+            if len(self.jobs) <= JOB_HISTORY:
+                break
+
+    def status(self):
+        statuses = {}
+        for job in self.jobs.values():
+            statuses[job['status']] = statuses.get(job['status'], 0) + 1
+        return {
+            'uptime': time.time() - self.started,
+            'workers': self.workers,
+            'pool_restarts': self.pool.restarts,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'connections': self.connections,
+            'counters': self.counters,
+            'jobs': statuses,
+            'files': self.metrics.file_count,
+            'bytes_in': self.metrics.bytes_in,
+            'bytes_out': self.metrics.bytes_out,
+            # 超出直方图范围的百分位数为 inf，JSON中表示为 null
+            'stages': {stage: {key: None if value == math.inf else value for key, value in item.items()}
+                       for stage, item in self.metrics.summary().items()},
+        }
+
+
+class _Reservation:
+    """ImageServer 的一个排队名额，release() 可以重复调用，只释放一次"""
+
+    def __init__(self, server):
+        self.server = server
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.server.pending -= 1
+
+    def transfer(self):
+        """把名额转交给新的持有者（例如后台任务），本对象的 release() 不再释放"""
+        self.released = True
+        return _Reservation(self.server)
+
+
+async def _read_head(reader):
+    """
+    读取一个HTTP请求的请求行和请求头，连接已关闭时返回None
+
+    Returns:
+        tuple: (方法, 请求目标, 请求头, 请求体长度)，请求体由调用方读取
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "无效的请求行")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'transfer-encoding' in headers:
+        raise HTTPError(HTTPStatus.NOT_IMPLEMENTED, "不支持分块传输，请指定 Content-Length")
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "无效的 Content-Length")
+    if length < 0:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "无效的 Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    return method.upper(), target, headers, length
+
+
+def _path(target):
+    return urlsplit(target).path.rstrip('/') or '/'
+
+
+async def _send(writer, status, content_type, payload, headers=None, keep_alive=True):
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}",
+             f"Content-Type: {content_type}",
+             f"Content-Length: {len(payload)}",
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+    await writer.drain()
+
+
+async def _send_json(writer, status, data, keep_alive=True, headers=None):
+    await _send(writer, status, 'application/json', _json_bytes(data), headers, keep_alive=keep_alive)
+
+
+def _json_bytes(data):
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def _color_param(value):
+    """解析背景色参数：颜色名、"#rrggbb" 或 [R, G, B]，未指定时为默认背景色"""
+    if value is None:
+        return DEFAULT_BACKGROUND
+    if isinstance(value, list) and len(value) == 3 and all(isinstance(v, int) and 0 <= v <= 255 for v in value):
+        return tuple(value)
+    if isinstance(value, str):
+        from PIL import ImageColor
+        try:
+            return ImageColor.getrgb(value)[:3]
+        except ValueError:
+            pass
+    raise HTTPError(HTTPStatus.BAD_REQUEST, f"无效的颜色: {value}")
+
+
+def _int_param(query, name, default):
+    try:
+        return int(query.get(name, default))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"参数 {name} 必须是整数")
+
+
+async def serve(host='127.0.0.1', port=8080, workers=None, max_pending=None):
+    """启动服务并一直运行，直到被中断"""
+    server = ImageServer(workers=workers, max_pending=max_pending)
+    listener = await server.start(host, port)
+    logger.warning("图片处理服务已启动: http://%s:%d (进程数 %d, 排队上限 %d)",
+                   host, port, server.workers, server.max_pending)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='图片处理HTTP服务')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址，默认只接受本机连接')
+    parser.add_argument('--port', type=int, default=8080, help='监听端口')
+    parser.add_argument('--workers', type=int, default=0, help='处理进程数，0表示使用全部CPU核心')
+    parser.add_argument('--max-pending', type=int, default=0, help='排队和执行中的任务数上限，默认为进程数的4倍')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers or None, args.max_pending or None))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+透明图片的处理：_flatten_alpha 与改动前的实现（白色背景 + split() 取出 alpha 通道作为蒙版）
+结果一致，压缩和多尺寸输出为JPEG时透明部分铺上背景色，PNG/WebP保留透明度
+"""
+import os
+
+import pytest
+from PIL import Image
+
+from image_processor import ImageProcessor, _flatten_alpha, parse_rendition
+
+SIZE = 32
+RED = (200, 30, 30)
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+
+
+def _reference_flatten(img, background=WHITE):
+    """改动前 compress_images 的做法：转换为RGBA后以 split() 得到的 alpha 通道粘贴到背景上"""
+    img = img.convert('RGBA')
+    flattened = Image.new('RGB', img.size, background)
+    flattened.paste(img, mask=img.split()[-1])
+    return flattened
+
+
+def _make_image(mode):
+    """左半边不透明的红色（LA 为灰色），右半边完全透明；RGBA 和 LA 的中间一列半透明"""
+    rgba = Image.new('RGBA', (SIZE, SIZE), RED + (0,))
+    for x in range(SIZE):
+        alpha = 255 if x < SIZE // 2 else 0
+        if x == SIZE // 2:
+            alpha = 128
+        for y in range(SIZE):
+            rgba.putpixel((x, y), RED + (alpha,))
+    if mode == 'RGBA':
+        return rgba
+    if mode == 'LA':
+        return rgba.convert('LA')
+    # 调色板图片：透明色单独占一个索引，以 tRNS 记录
+    palette = Image.new('P', (SIZE, SIZE), 0)
+    palette.putpalette(list(RED) + list(BLACK) + [0, 0, 0] * 254)
+    for x in range(SIZE // 2, SIZE):
+        for y in range(SIZE):
+            palette.putpixel((x, y), 1)
+    palette.info['transparency'] = 1
+    return palette
+
+
+def _expected_color(img, background, x):
+    """JPEG 输出中第 x 列应有的颜色"""
+    return _reference_flatten(img, background).getpixel((x, 0))
+
+
+def _assert_close(actual, expected, tolerance=8):
+    assert all(abs(a - e) <= tolerance for a, e in zip(actual, expected)), (actual, expected)
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for mode in ('P', 'RGBA', 'LA'):
+        _make_image(mode).save(source / f'{mode.lower()}.png')
+    return source
+
+
+@pytest.mark.parametrize('mode', ['P', 'RGBA', 'LA'])
+@pytest.mark.parametrize('background', [WHITE, (10, 120, 250)])
+def test_flatten_matches_previous_implementation(mode, background):
+    img = _make_image(mode)
+    assert _flatten_alpha(img, background).tobytes() == _reference_flatten(img, background).tobytes()
+
+
+def test_flatten_keeps_opaque_modes():
+    img = Image.new('RGB', (4, 4), RED)
+    assert _flatten_alpha(img) is img
+    palette = Image.new('P', (4, 4), 0)
+    assert _flatten_alpha(palette).mode == 'RGB'
+
+
+@pytest.mark.parametrize('background', [WHITE, (10, 120, 250)])
+def test_compress_flattens_onto_background(image_dir, tmp_path, background):
+    output_dir = tmp_path / 'compressed'
+    ImageProcessor(str(image_dir)).compress_images(quality=90, output_dir=str(output_dir), background=background)
+    for mode in ('P', 'RGBA', 'LA'):
+        source = _make_image(mode)
+        with Image.open(output_dir / f'{mode.lower()}.jpg') as output:
+            assert output.mode in ('RGB', 'L')
+            output = output.convert('RGB')
+            for x in (2, SIZE - 3):
+                _assert_close(output.getpixel((x, SIZE // 2)), _expected_color(source, background, x))
+
+
+def test_renditions_flatten_jpeg_and_keep_alpha(image_dir, tmp_path):
+    output_dir = tmp_path / 'renditions'
+    background = (10, 120, 250)
+    ImageProcessor(str(image_dir)).create_renditions([parse_rendition(f'full:{SIZE}x{SIZE}:jpeg,png,webp')],
+                                                     output_dir=str(output_dir), quality=90, background=background)
+    for mode in ('P', 'RGBA', 'LA'):
+        source = _make_image(mode)
+        stem = mode.lower()
+        with Image.open(output_dir / f'{stem}_full.jpg') as output:
+            output = output.convert('RGB')
+            for x in (2, SIZE - 3):
+                _assert_close(output.getpixel((x, SIZE // 2)), _expected_color(source, background, x))
+        for ext in ('png', 'webp'):
+            path = output_dir / f'{stem}_full.{ext}'
+            assert os.path.exists(path)
+            with Image.open(path) as output:
+                output = output.convert('RGBA')
+                assert output.getpixel((2, SIZE // 2))[3] == 255
+                assert output.getpixel((SIZE - 3, SIZE // 2))[3] == 0
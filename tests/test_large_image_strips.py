@@ -0,0 +1,68 @@
+"""
+大图模式按条带解码：不带透明度的图片与整张解码后 Image.resize(..., reducing_gap=...) 的结果逐字节一致
+
+条带解码用到 Pillow 的内部接口（Image._getdecoder）并重新组装PNG的行过滤数据，
+升级 Pillow 后输出可能悄悄改变，这里用较小的 LARGE_IMAGE_PIXELS 和 STRIP_BYTES 覆盖多个条带。
+"""
+import pytest
+from PIL import Image
+
+import image_processor
+from image_processor import _reduce_in_strips, _resize_to_fit, _StageTimer
+
+# 宽度为奇数，BMP每行需要补齐到4字节；高度不是条带高度的整数倍
+SIZE = (301, 157)
+FINAL_SIZE = (50, 26)
+REDUCING_GAP = 2.0
+
+
+def _make_image(mode):
+    """渐变叠加噪声，PNG编码时会用到各种行过滤方式"""
+    noise = Image.effect_noise(SIZE, 40)
+    gradient = Image.linear_gradient('L').resize(SIZE)
+    if mode == 'L':
+        return Image.blend(noise, gradient, 0.5)
+    return Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+
+@pytest.fixture(autouse=True)
+def small_strips(monkeypatch):
+    monkeypatch.setattr(image_processor, 'LARGE_IMAGE_PIXELS', 1000)
+    # 每个条带只有十几行，整张图片分成多个条带
+    monkeypatch.setattr(image_processor, 'STRIP_BYTES', SIZE[0] * 4 * 16)
+
+
+@pytest.mark.parametrize('mode, extension, params', [
+    ('RGB', 'png', {}),
+    ('L', 'png', {}),
+    ('RGB', 'tif', {'compression': 'raw'}),
+    ('RGB', 'bmp', {}),
+])
+def test_strips_match_full_decode(tmp_path, mode, extension, params):
+    path = tmp_path / f'image.{extension}'
+    _make_image(mode).save(path, **params)
+
+    with Image.open(path) as img:
+        if extension == 'bmp':
+            # Pillow 保存的BMP自下而上存放各行
+            assert img.tile[0][3][2] == -1
+        reduced = _reduce_in_strips(img, FINAL_SIZE, REDUCING_GAP, _StageTimer())
+    assert reduced is not None, "该格式应当按条带解码"
+
+    with Image.open(path) as img:
+        expected = img.resize(FINAL_SIZE, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    assert reduced.mode == expected.mode
+    assert reduced.size == expected.size
+    assert reduced.tobytes() == expected.tobytes()
+
+
+def test_resize_to_fit_uses_strips(tmp_path):
+    path = tmp_path / 'image.png'
+    _make_image('RGB').save(path)
+    with Image.open(path) as img:
+        result = _resize_to_fit(img, *FINAL_SIZE, REDUCING_GAP, _StageTimer())
+        # 按条带解码时不会加载整张图片，load() 之后 tile 会被清空
+        assert img.tile
+    with Image.open(path) as img:
+        expected = img.resize(FINAL_SIZE, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    assert result.tobytes() == expected.tobytes()
@@ -0,0 +1,15 @@
+"""延迟导入的 PIL.Image 与普通导入一样可以通过 PIL 包访问"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_pil_image_attribute_after_import():
+    # 在新的解释器中执行，避免其他测试已经导入 PIL.Image
+    code = ("import image_processor\n"
+            "import PIL.Image\n"
+            "assert PIL.Image.new('RGB', (2, 2)).size == (2, 2)\n"
+            "assert image_processor.Image is PIL.Image\n")
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
@@ -0,0 +1,24 @@
+"""按目标文件大小选择JPEG质量：不超过用户指定的质量"""
+from PIL import Image
+
+from image_processor import TARGET_SIZE_MIN_QUALITY, _encode_jpeg_to_target
+
+
+def _noise():
+    return Image.effect_noise((200, 200), 80).convert('RGB')
+
+
+def test_quality_below_search_minimum_is_kept():
+    data, quality = _encode_jpeg_to_target(_noise(), 100, TARGET_SIZE_MIN_QUALITY - 5)
+    assert quality == TARGET_SIZE_MIN_QUALITY - 5
+    assert data[:2] == b'\xff\xd8'
+
+
+def test_unreachable_target_uses_min_quality():
+    _, quality = _encode_jpeg_to_target(_noise(), 100, 85)
+    assert quality == TARGET_SIZE_MIN_QUALITY
+
+
+def test_reachable_target_keeps_max_quality():
+    _, quality = _encode_jpeg_to_target(_noise(), 10 ** 7, 85)
+    assert quality == 85